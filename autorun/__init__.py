@@ -1,58 +1,107 @@
 import fastapi
-import os
+import pydantic
 import sys
-import tempfile
-import subprocess
 import logging
-import pathlib
-import json
 import asyncio
 import hashlib
 import hmac
-import urllib.request
+import contextlib
+import importlib.util
+import typing
+import hypercorn.run
 from hypercorn.config import Config
 from hypercorn.asyncio import serve
 
-from .github_models import Ping, PullRequest, GithubJobs, WorkflowJob
+from .github_models import parse_event
 from .config import config
+from . import github_api
+from . import json_logging
+from . import metrics
 from .hypercorn_logger import Logger
+from .pipeline import handle_pull_request, coalesce_key, push_order, is_newer, state_key, repository_group, repository_limit, git_cache, access_check, shared_state, decision_cache
+from .workers import WorkQueue
+from .deliveries import DeliveryIndex, DeliveryStore
 
 __version__ = "0.0.1"
 
-app = fastapi.FastAPI()
-
-# .. todo::
-#    Clean up the "JSON" logger, to be more robust.
-#    But we do want the format to be machine parse:able.
-
-log = logging.getLogger()
-log.setLevel(config.api.log_level)
-log_stdout = logging.StreamHandler(sys.stdout)
-log_stdout.setLevel(config.api.log_level)
-log_stdout.setFormatter(
-	logging.Formatter(json.dumps({
-		"human_time" : "%(asctime)s",
-		"logger_name": "%(process)d",
-		"level": "%(levelname)s",
-		"message": "%(message)s"
-	}))
+async def process(payload) -> bool|None:
+	"""
+	Runs handle_pull_request(). If it fails, the delivery is forgotten, so that
+	hitting "Redeliver" in GitHub's UI verifies the PR again instead of being ignored.
+	"""
+	try:
+		return await handle_pull_request(payload)
+	except Exception:
+		if payload.delivery:
+			await deliveries.discard(payload.delivery)
+		raise
+
+work_queue = WorkQueue(process, config.workers.count, config.workers.queue_size, coalesce_key, repository_group, repository_limit, is_newer)
+
+deliveries = DeliveryIndex(
+	config.api.delivery_ttl,
+	config.api.delivery_entries,
+	DeliveryStore(config.api.delivery_path or config.cache.path / 'deliveries.sqlite3', config.api.delivery_ttl, config.api.delivery_entries)
 )
 
-log.addHandler(log_stdout)
+metrics.Gauge('autorun_verifications_in_progress', 'PR verifications currently running.', function=lambda: work_queue.busy)
+metrics.Gauge('autorun_work_queue_depth', 'PR events waiting to be verified.', function=work_queue.depth)
+metrics.Gauge('autorun_deliveries_remembered', 'Delivery ids remembered to recognize redeliveries.', function=lambda: len(deliveries))
+
+def rate_limit_gauge(field :str) -> typing.Callable[[], dict]:
+	# Per access token (by the repositories using it), leaving out what GitHub hasn't told us yet
+	return lambda: {(repositories,): budget[field] for repositories, budget in github_api.budgets().items() if budget[field] is not None}
+
+metrics.Gauge('autorun_rate_limit_remaining', 'GitHub API calls left in the current rate limit window.', ('repositories',), function=rate_limit_gauge('remaining'))
+metrics.Gauge('autorun_rate_limit_limit', 'GitHub API calls allowed per rate limit window.', ('repositories',), function=rate_limit_gauge('limit'))
+metrics.Gauge('autorun_rate_limit_used_ratio', 'Share of the rate limit window used.', ('repositories',), function=rate_limit_gauge('used_ratio'))
+metrics.Gauge('autorun_rate_limit_blocked_seconds', 'Seconds left of backing off from the GitHub API.', ('repositories',), function=rate_limit_gauge('blocked_for'))
+metrics.Gauge('autorun_rate_limit_waiting', 'GitHub API calls waiting for the rate limit scheduler, by priority.', ('repositories', 'priority'), function=lambda: {
+	(repositories, priority): budget[f"waiting_{priority}"]
+	for repositories, budget in github_api.budgets().items()
+	for priority in ('high', 'low')
+})
+
+@contextlib.asynccontextmanager
+async def lifespan(app :fastapi.FastAPI):
+	# Runs in the background, webhooks are accepted (and queued) right away
+	access_check.start(config.repositories, config.github.api_retries, config.github.api_retry_backoff, config.github.api_max_backoff)
+	await work_queue.start()
+	yield
+	await work_queue.stop()
+	await access_check.stop()
+	await git_cache.stop()
+	await github_api.close()
+	shared_state.close()
+	decision_cache.close()
+	deliveries.close()
+
+app = fastapi.FastAPI(lifespan=lifespan)
+
+# JSON lines on stdout, written from a background thread
+log = json_logging.setup(config.api.log_level, sys.stdout)
 
 if config.github.secret is None:
 	log.warning(f"No secret has been configured, anyone can post to your webhook!")
 
-def run_as_a_module():
-	logging.getLogger("hypercorn.error").setLevel(config.api.log_level)
-	logging.getLogger("hypercorn.access").setLevel(config.api.log_level)
+class EndpointFilter(logging.Filter):
+	def filter(self, record: logging.LogRecord) -> bool:
+		message = record.getMessage()
+		return all(message.find(f"GET {path} ") == -1 for path in ('/healthcheck', '/readiness', '/metrics'))
 
-	class EndpointFilter(logging.Filter):
-		def filter(self, record: logging.LogRecord) -> bool:
-			return record.getMessage().find("GET /healthcheck ") == -1
+# Set up on import, as the hypercorn worker processes only import the app
+logging.getLogger("hypercorn.error").setLevel(config.api.log_level)
+logging.getLogger("hypercorn.access").setLevel(config.api.log_level)
+# Filter out probes and Prometheus scrapes to not spam access log too much
+logging.getLogger("hypercorn.access").addFilter(EndpointFilter())
+# And keep bursts of deliveries from flooding it
+logging.getLogger("hypercorn.access").addFilter(json_logging.RateLimitFilter(config.api.access_log_rate, config.api.access_log_burst))
 
-	# Filter out /healthcheck to not spam access log too much
-	logging.getLogger("hypercorn.access").addFilter(EndpointFilter())
+def run_as_a_module():
+	event_loop = config.api.event_loop
+	if event_loop == 'uvloop' and importlib.util.find_spec('uvloop') is None:
+		log.warning(f"uvloop is not installed, falling back to the asyncio event loop")
+		event_loop = 'asyncio'
 
 	corn_conf = Config()
 	corn_conf.bind = f"{config.api.address}:{config.api.port}"
@@ -64,179 +113,222 @@ def run_as_a_module():
 	corn_conf.use_reloader = False
 	corn_conf.accesslog = '-'
 	corn_conf.logger_class = Logger
-	# Slight variation to the default format: https://pgjones.gitlab.io/hypercorn/how_to_guides/logging.html#configuring-access-logs
-	# As we need to account for our 'json formatter' not dealing with quotations.
-	corn_conf.access_log_format = '%(h)s %(l)s %(l)s %(t)s \\\\"%(r)s\\\\" %(s)s %(b)s \\\\"%(f)s\\\\" \\\\"%(a)s\\\\"'
+	# The default format: https://pgjones.gitlab.io/hypercorn/how_to_guides/logging.html#configuring-access-logs
+	corn_conf.access_log_format = '%(h)s %(l)s %(l)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s"'
 	corn_conf.errorlog = '-'
 
-	asyncio.run(serve(app, corn_conf))
+	if config.api.workers > 1:
+		# Hypercorn binds the socket and starts the worker processes,
+		# each of which imports the app by itself and serves on the shared socket.
+		corn_conf.application_path = f"{__name__}:app"
+		corn_conf.workers = config.api.workers
+		corn_conf.worker_class = event_loop
 
-def verify_signature(payload :bytes, signature :str):
+		sys.exit(hypercorn.run.run(corn_conf))
+	elif event_loop == 'uvloop':
+		import uvloop
+
+		with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+			runner.run(serve(app, corn_conf))
+	else:
+		asyncio.run(serve(app, corn_conf))
+
+async def read_signed_body(request :fastapi.Request) -> tuple[bytes|None, bool]:
 	"""
-	Used to validate webhook deliveries:
+	Reads the webhook body as it streams in, feeding each chunk to the HMAC as it arrives
+	so nothing is parsed before we know the delivery came from GitHub:
 	 * https://docs.github.com/en/webhooks/using-webhooks/validating-webhook-deliveries
+
+	Returns (None, False) if the body is larger than :code:`config.api.max_body_size`,
+	otherwise the body and if the signature matched (always True when no secret is configured).
 	"""
-	hash_object = hmac.new(config.github.secret.encode('utf-8'), msg=payload, digestmod=hashlib.sha256)
-	expected_signature = "sha256=" + hash_object.hexdigest()
+	if (content_length := request.headers.get('Content-Length', '')).isdigit() and int(content_length) > config.api.max_body_size:
+		return None, False
 
-	if hmac.compare_digest(expected_signature, signature):
-		return True
+	hash_object = hmac.new(config.github.secret.encode('utf-8'), digestmod=hashlib.sha256) if config.github.secret else None
 
-	return False
+	chunks = []
+	size = 0
+	async for chunk in request.stream():
+		size += len(chunk)
+		if size > config.api.max_body_size:
+			return None, False
 
-def list_pr_jobs(headers, payload):
-	# List all runners associated with the PR head sha sum
-	request = urllib.request.Request(
-		f'https://api.github.com/repos/{payload.pull_request.base.repo.full_name}/actions/runs?' \
-		+ f'event=pull_request' \
-		#+ f'&status=action_required' \
-		+ f'&head_sha={payload.pull_request.head.sha}',
-		method="GET",
-		headers=headers
-	)
+		if hash_object:
+			hash_object.update(chunk)
+		chunks.append(chunk)
 
-	# Iterate any job related to the PR
-	with urllib.request.urlopen(request) as response:
-		info = response.info()
-		if info.get_content_subtype() == 'json':
-			data = json.loads(response.read().decode(info.get_content_charset('utf-8')))
-			jobs = GithubJobs(**data)
-			for job in jobs.workflow_runs:
-				if job.head_commit.id != payload.pull_request.head.sha:
-					log.warning(f"Job {job.head_commit.id} does not match pull requests {payload.pull_request.head.sha}")
+	body = b''.join(chunks)
 
-					# Something's fishy, and we're out of chips!
-					return fastapi.Response(
-						status_code=fastapi.status.HTTP_403_FORBIDDEN
-					)
+	if hash_object is None:
+		return body, True
 
-				log.debug(f"Found job '{job.name}' related to Pull Requests {', '.join(['#'+str(pr.number) for pr in job.pull_requests])} called '{job.display_title}'")
-				yield job
+	expected_signature = "sha256=" + hash_object.hexdigest()
 
+	return body, hmac.compare_digest(expected_signature, request.headers.get('X-Hub-Signature-256', ''))
 
 @app.post('/github/')
-async def webhook_entry(payload :Ping|PullRequest|WorkflowJob, request :fastapi.Request, response :fastapi.Response):
+async def webhook_entry(request :fastapi.Request):
+	# Arbitrary header values are not worth a time series each
+	event = request.headers.get('X-GitHub-Event', '')
+	event_label = event if event in metrics.KNOWN_EVENTS else 'other'
+
+	with metrics.stage_seconds.time('signature'):
+		body, valid = await read_signed_body(request)
+
+	if body is None:
+		metrics.webhook_requests.inc(event_label, '', 'too_large')
+		log.warning(f"Webhook body is larger than {config.api.max_body_size} bytes, ignoring request", extra={"delivery": request.headers.get('X-GitHub-Delivery')})
+
+		return fastapi.Response(
+			status_code=413
+		)
+
 	# We validate the webhook secret, only if we configured one
-	if config.github.secret and verify_signature(await request.body(), request.headers.get('X-Hub-Signature-256')) is not True:
-		log.warning(f"Invalid webhook signature, ignoring request (make sure your secret match on the webhook and in TOML config)")
+	if valid is not True:
+		metrics.webhook_requests.inc(event_label, '', 'forbidden')
+		log.warning(f"Invalid webhook signature, ignoring request (make sure your secret match on the webhook and in TOML config)", extra={"delivery": request.headers.get('X-GitHub-Delivery')})
 
 		return fastapi.Response(
 			status_code=fastapi.status.HTTP_403_FORBIDDEN
 		)
 
+	# Only authenticated bytes get here. Only the model of the event in the
+	# X-GitHub-Event header is parsed, straight from the bytes by pydantic's own JSON parser,
+	# events we don't act on are accepted without looking at the body.
+	try:
+		with metrics.stage_seconds.time('parse'):
+			payload = parse_event(event, body)
+	except pydantic.ValidationError as error:
+		metrics.webhook_requests.inc(event_label, '', 'invalid')
+		log.warning(f"Invalid {request.headers.get('X-GitHub-Event')} payload: {error.error_count()} validation errors", extra={"delivery": request.headers.get('X-GitHub-Delivery')})
+
+		return fastapi.Response(
+			status_code=422
+		)
+
 	# Ignore by accepting all non-PR payloads
-	if not isinstance(payload, PullRequest):
+	if payload is None:
+		metrics.webhook_requests.inc(event_label, '', 'ignored')
 		return fastapi.Response(
 			status_code=202
 		)
 
 	# Ignore by accepting PR hooks that are not:
 	if payload.action not in ('opened', 'synchronize', 'reopened'):
+		metrics.webhook_requests.inc(event_label, payload.action, 'ignored')
+		return fastapi.Response(
+			status_code=202
+		)
+
+	# Only PR's against the repositories we're configured for
+	if config.repository(payload.pull_request.base.repo.full_name) is None:
+		metrics.webhook_requests.inc(event_label, payload.action, 'unknown_repository')
+		log.warning(f"Ignoring PR #{payload.pull_request.number} against {payload.pull_request.base.repo.full_name}, it has no configuration", extra={"delivery": request.headers.get('X-GitHub-Delivery')})
+
 		return fastapi.Response(
 			status_code=202
 		)
 
-	# Used to call the GitHub API during queries
-	headers = {
-		"Accept": "application/vnd.github+json",
-		"Authorization": f"Bearer {config.github.access_token}",
-		"X-GitHub-Api-Version": "2022-11-28"
-	}
-
-	# payload.head < PR reference
-	# payload.base < Target reference
-
-	# .. todo::
-	#    Perhaps we can optimize here, and check if the payload.sender is an outside collaborator
-	#    and only perform our checks if that is the case. As there is no way to force all runners to be approved.
-	#    Only outside collaborators - unless Workaround 3 is chosen: https://md.archlinux.org/s/aIL4kaCtY#workaround-3
-
-	log.info(f"Verifying that the PR #{payload.pull_request.number} \\\"{payload.pull_request.title}\\\" does not modify any proected paths defined in the config.")
-
-	with tempfile.TemporaryDirectory() as tempdir:
-		# Clone the repo in question
-		log.debug(f"git clone {payload.pull_request.base.repo.html_url}@{payload.pull_request.base.ref}")
-		subprocess.run(f"git clone -q --branch \"{payload.pull_request.base.ref}\" --single-branch -- \"{payload.pull_request.base.repo.html_url}\" \"{tempdir}/{payload.pull_request.base.repo.name}\"", capture_output=True, shell=True, cwd=tempdir)
-
-		# Add the PR repo/branch
-		log.debug(f"git remote add \\\"pr\\\" {payload.pull_request.head.repo.full_name}@{payload.pull_request.head.ref}")
-		subprocess.run(f"git remote add pr -- \"{payload.pull_request.head.repo.html_url}\"", capture_output=True, shell=True, cwd=f"{tempdir}/{payload.pull_request.base.repo.name}")
-
-		# Update all the remotes (repo + pr)
-		log.debug(f"git remote update {payload.pull_request.base.repo.full_name}@{payload.pull_request.base.ref} and {payload.pull_request.head.repo.full_name}@{payload.pull_request.head.ref}")
-		subprocess.run(f"git remote update", capture_output=True, shell=True, cwd=f"{tempdir}/{payload.pull_request.base.repo.name}")
-
-		# git diff - files
-		file_changes = subprocess.run(f"git diff --name-only -- \"{payload.pull_request.base.ref}\" \"pr/{payload.pull_request.head.ref}\"", capture_output=True, shell=True, cwd=f"{tempdir}/{payload.pull_request.base.repo.name}").stdout.decode().strip().split('\n')
-		log.debug(f"Files modified: {json.dumps(file_changes).replace('"', '\\"')}")
-
-		# Check if any file lives in .github/workflows
-		if config.github.protected:
-			cancel_runners = False
-			for filename in file_changes:
-				if filename == '': continue
-
-				for regex in config.github.protected:
-					if regex.search(filename) is not None:
-						cancel_runners = True
-						break
-
-				if cancel_runners:
-					break
-
-			if cancel_runners:
-				log.warning(f"Cancelling runners in PR from executing, as they have modified proected file: {filename}")
-
-				for job in list_pr_jobs(headers, payload):
-					if job.status != 'completed':
-						log.info(f"Cancelling job '{job.name}'")
-						request = urllib.request.Request(
-							f'https://api.github.com/repos/{payload.pull_request.base.repo.full_name}/actions/runs/{job.id}/cancel',
-							method="POST",
-							headers=headers
-						)
-
-						with urllib.request.urlopen(request) as response:
-							info = response.info()
-							log.info(f"Canceled job '{job.name}'")
-
-					# Deleting jobs, will allow PR's to be merged as there will be
-					# no incomplete jobs blocking the merger. If that's what we want, uncomment this:
-
-					# request = urllib.request.Request(
-					# 	f'https://api.github.com/repos/{payload.pull_request.base.repo.full_name}/actions/runs/{job.id}',
-					# 	method="DELETE",
-					# 	headers=headers
-					# )
-
-					# with urllib.request.urlopen(request) as response:
-					# 	info = response.info()
-					# 	log.info(f"Deleted job '{job.name}'")
-
-				return fastapi.Response(
-					status_code=fastapi.status.HTTP_403_FORBIDDEN
-				)
-
-			log.info(f"PR did not modify any configured protected paths")
-		else:
-			log.warning(f"No paths are defined as proected in the configuration.")
-
-		# All should be good here,
-		# lets approve the individual runners (I don't think there's a batch approval?)
-		for job in list_pr_jobs(headers, payload):
-			if job.status != 'completed':
-				request = urllib.request.Request(
-					f'https://api.github.com/repos/{payload.pull_request.base.repo.full_name}/actions/runs/{job.id}/approve',
-					method="POST",
-					headers=headers
-				)
-
-				with urllib.request.urlopen(request) as response:
-					info = response.info()
-					log.info(f"Started job '{job.name}'")
+	# GitHub redelivers on timeouts, and anyone can hit "Redeliver" in the UI.
+	# Those have the same delivery id, and were already queued once.
+	delivery = payload.delivery = request.headers.get('X-GitHub-Delivery')
+	if delivery and await deliveries.add(delivery) is False:
+		metrics.webhook_requests.inc(event_label, payload.action, 'duplicate')
+		log.info(f"Delivery {delivery} of PR #{payload.pull_request.number} was already queued, ignoring the redelivery", extra={"delivery": delivery})
+
+		return fastapi.Response(
+			status_code=202
+		)
+
+	# Let the other processes know about the push, so they don't approve an older head.
+	# Unless it's a late retry or redelivery of an older push, which must not replace a newer head.
+	if await asyncio.to_thread(shared_state.set_latest, state_key(payload), *push_order(payload)) is False:
+		metrics.webhook_requests.inc(event_label, payload.action, 'outdated')
+		log.info(f"Ignoring PR #{payload.pull_request.number} at {payload.pull_request.head.sha}, a newer push has been received", extra={"delivery": delivery})
+
+		return fastapi.Response(
+			status_code=202
+		)
+
+	# The verification happens in the background, as it can take
+	# longer than GitHub is willing to wait for the delivery to finish.
+	if work_queue.submit(payload) is False:
+		metrics.webhook_requests.inc(event_label, payload.action, 'rejected')
+		# Not queued, so GitHub's redelivery should be
+		if delivery:
+			await deliveries.discard(delivery)
+
+		return fastapi.Response(
+			status_code=fastapi.status.HTTP_503_SERVICE_UNAVAILABLE
+		)
+
+	metrics.webhook_requests.inc(event_label, payload.action, 'queued')
 
 	# If everything went according to plan, then we
 	# return '202 Accepted' to the webhook caller (has little effect, but is good practice)
 	return fastapi.Response(
 		status_code=202
+	)
+
+@app.get('/healthcheck')
+async def healthcheck_entry():
+	# Liveness only, never touches git or GitHub. As the verification
+	# runs in the background workers, this answers even during a long clone.
+	return {"status": "ok"}
+
+@app.get('/readiness')
+async def readiness_entry():
+	"""
+	Tells an orchestrator if we can take on more work right now,
+	answering 503 with the reasons if not. Only looks at in-memory state
+	and a stat of the cache directory, so it stays cheap under load.
+	"""
+	workers = work_queue.stats()
+	cache = git_cache.health()
+	rate_limit = github_api.budgets()
+	access = access_check.status()
+
+	reasons = []
+	for repository, group in workers["groups"].items():
+		if group["queued"] >= workers["queue_size"]:
+			reasons.append(f"work queue of {repository} is full")
+	if workers["wait_seconds_oldest"] > config.workers.max_wait:
+		reasons.append(f"oldest queued event has waited more than {config.workers.max_wait}s")
+	if not cache["healthy"]:
+		reasons.append("git cache is not writable or out of disk space")
+	for repositories, budget in rate_limit.items():
+		if budget["blocked_for"] > 0:
+			reasons.append(f"backing off from the GitHub API for {repositories}")
+	for repository in access["errors"]:
+		# Repositories we couldn't reach GitHub for are still verified, and keep being checked
+		if repository not in access["retrying"]:
+			reasons.append(f"no access to {repository}")
+
+	return fastapi.responses.JSONResponse(
+		{
+			"ready": not reasons,
+			"reasons": reasons,
+			"workers": workers,
+			"cache": cache,
+			"rate_limit": rate_limit,
+			"access": access,
+		},
+		status_code=200 if not reasons else fastapi.status.HTTP_503_SERVICE_UNAVAILABLE
+	)
+
+@app.get('/workers')
+async def workers_entry():
+	return work_queue.stats()
+
+@app.get('/ratelimit')
+async def ratelimit_entry():
+	# Per access token, by the repositories using it
+	return github_api.budgets()
+
+@app.get('/metrics')
+async def metrics_entry():
+	return fastapi.Response(
+		content=metrics.render(),
+		media_type="text/plain; version=0.0.4"
 	)
\ No newline at end of file
@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import typing
+import httpx
+
+from . import github_api
+from .rate_limit import Priority
+
+"""
+Verifies that the configured access tokens can see their repositories.
+This used to be a blocking call to api.github.com while the config was
+being loaded, which made importing autorun need the network. Now the config
+loads without it, and the check runs in the background once we're serving.
+Verifications wait for the first round of checks of their repository. Only
+definitive answers are kept for the lifetime of the process (the token can or
+can't see the repository). If GitHub couldn't be reached or kept us rate limited,
+verifications go ahead (their own calls will tell) and the check keeps retrying
+in the background, with a backoff capped at :code:`max_backoff`. The lookup goes
+through the conditional GET cache, so a restart with a persisted cache only costs a 304.
+"""
+
+log = logging.getLogger()
+
+class AccessCheck:
+	def __init__(self):
+		# Per repository: True if the token can see it, False if not, missing while it's not known
+		self.results :dict[str, bool] = {}
+		self.errors :dict[str, str] = {}
+		# Set once the first round of attempts is over, known or not
+		self._settled :dict[str, asyncio.Event] = {}
+		self._tasks :dict[str, asyncio.Task] = {}
+
+	def start(self, repositories :typing.Mapping[str, typing.Any], retries :int, backoff :float, max_backoff :float):
+		"""
+		Starts checking every repository in :code:`repositories` (full name to its settings) concurrently.
+		"""
+		for full_name, repository in repositories.items():
+			if full_name not in self._tasks:
+				self._settled[full_name] = asyncio.Event()
+				self._tasks[full_name] = asyncio.create_task(self.run(full_name, repository.access_token, retries, backoff, max_backoff))
+
+	async def run(self, full_name :str, access_token :str, retries :int, backoff :float, max_backoff :float):
+		"""
+		Checks until we get a definitive answer, rounds of :code:`retries` attempts at a time.
+		"""
+		delay = min(backoff * 2 ** retries, max_backoff)
+		try:
+			while not await self.attempt(full_name, access_token, retries, backoff):
+				self._settled[full_name].set()
+
+				log.warning(f"Could not verify access to {full_name}, trying again in {delay:.0f}s")
+				await asyncio.sleep(delay)
+				delay = min(delay * 2, max_backoff)
+		finally:
+			# Never leave verifications waiting on a check that's no longer running
+			self._settled[full_name].set()
+
+	async def attempt(self, full_name :str, access_token :str, retries :int, backoff :float) -> bool:
+		"""
+		Runs :code:`check()`, an error that isn't an HTTP error (a broken response body, say)
+		is no answer either, so it's retried like GitHub being unreachable.
+		"""
+		try:
+			return await self.check(full_name, access_token, retries, backoff)
+		except Exception as error:
+			log.exception(f"Could not verify access to {full_name}: {error}")
+			self.errors[full_name] = f"Could not verify access to {full_name}: {error}"
+			return False
+
+	async def check(self, full_name :str, access_token :str, retries :int, backoff :float) -> bool:
+		"""
+		Returns True if we got a definitive answer, False if GitHub couldn't be reached.
+		"""
+		headers = {
+			"Accept": "application/vnd.github+json",
+			"Authorization": github_api.authorization(access_token),
+			"X-GitHub-Api-Version": "2022-11-28"
+		}
+
+		# /repos/OWNER/REPO - https://docs.github.com/en/rest/repos/repos?apiVersion=2022-11-28#get-a-repository
+		url = f'{github_api.API_URL}/repos/{full_name}'
+
+		for attempt in range(1, retries + 1):
+			try:
+				response = await github_api.get(url, headers, Priority.HIGH)
+			except httpx.HTTPError as error:
+				if attempt < retries and github_api.is_transient(error):
+					log.warning(f"Could not verify access to {full_name} (attempt {attempt}): {error}")
+					await asyncio.sleep(backoff * 2 ** (attempt - 1))
+					continue
+
+				if github_api.is_transient(error):
+					# Not an answer, the next round will tell
+					self.errors[full_name] = f"Could not reach GitHub to verify access to {full_name}: {error}"
+					return False
+
+				if isinstance(error, httpx.HTTPStatusError) and error.response.status_code == 401:
+					self.fail(full_name, f"Could not use configured access token for {full_name}, potentially it has expired.")
+				else:
+					self.fail(full_name, f"Could not verify access to {full_name}: {error}")
+				return True
+
+			if response.headers.get('Content-Type', '').startswith('application/json') and response.json().get('full_name', None) != full_name:
+				self.fail(full_name, f"Could not fetch configured repository info: {full_name}")
+				return True
+
+			log.info(f"Verified access to {full_name}")
+			self.results[full_name] = True
+			self.errors.pop(full_name, None)
+			return True
+
+		return False
+
+	def fail(self, full_name :str, message :str):
+		log.error(message)
+		self.results[full_name] = False
+		self.errors[full_name] = message
+
+	async def wait(self, full_name :str) -> bool:
+		"""
+		Waits for the first round of checks of the repository. Returns False if we
+		know we don't have access to it, True if we do or couldn't find out (yet).
+		"""
+		if full_name not in self._tasks:
+			from .config import config
+
+			self.start(config.repositories, config.github.api_retries, config.github.api_retry_backoff, config.github.api_max_backoff)
+
+		if (settled := self._settled.get(full_name)) is None:
+			# Not a repository we serve
+			return False
+
+		await settled.wait()
+
+		return self.results.get(full_name, True)
+
+	def status(self) -> dict:
+		return {
+			"done": all(settled.is_set() for settled in self._settled.values()),
+			"verified": sorted(full_name for full_name, result in self.results.items() if result),
+			"retrying": sorted(full_name for full_name in self.errors if full_name not in self.results),
+			"errors": self.errors,
+		}
+
+	async def stop(self):
+		for task in self._tasks.values():
+			task.cancel()
+
+		await asyncio.gather(*self._tasks.values(), return_exceptions=True)
@@ -0,0 +1,129 @@
+import time
+import logging
+import typing
+import contextlib
+
+from . import github_api
+from . import metrics
+from .git_cache import MirrorCache
+
+"""
+Providers that answer "which files did this pull request change?".
+The protected path check in webhook_entry() only needs the file names,
+so for most PR's we can ask the GitHub REST API instead of touching git at all.
+Providers yield the file names in batches (a page, or a chunk of the diff), which lets
+the protected path matcher run over a whole batch in one tight loop.
+
+Both only ever look at the base and head commits of the event, never at where the
+branches are by now. They don't compare them the same way though: git diffs the two
+trees, so changes made to the base branch since the PR forked off count as changed
+too, while the API lists the PR's own changes (from the merge base on). Each says
+which it does in :code:`comparison`, and verdicts are only reused for the same one.
+"""
+
+log = logging.getLogger()
+
+# The compare endpoint stops listing files after this many, for the whole comparison:
+#  * https://docs.github.com/en/rest/commits/commits?apiVersion=2022-11-28#compare-two-commits
+API_FILE_LIMIT = 300
+API_PAGE_SIZE = 100
+
+class ChangedFilesProvider(typing.Protocol):
+	"""
+	What the different ways of listing the changed files in a PR have in common.
+	"""
+	# The strategy, as in metrics and logs
+	name :str
+	comparison :str
+
+	def changed_files(self, payload) -> typing.AsyncIterator[list[str]]:
+		...
+
+class GitProvider:
+	"""
+	Fetches the base branch and PR head into the mirror cache and runs git diff.
+	Works for any PR size, but costs a fetch. With :code:`shallow` only the
+	two tip commits and their trees are fetched (depth 1), otherwise the mirror
+	keeps the full history which makes later fetches incremental. Blobs are never fetched.
+	"""
+	def __init__(self, git_cache :MirrorCache, shallow :bool = False):
+		self.git_cache = git_cache
+		self.shallow = shallow
+		self.name = 'shallow' if shallow else 'full'
+		# A depth=1 mirror has no merge base, so the trees are compared directly (base..head)
+		self.comparison = 'trees'
+
+	async def changed_files(self, payload) -> typing.AsyncIterator[list[str]]:
+		base = payload.pull_request.base
+		head = payload.pull_request.head
+
+		# Fetch the base branch and the PR head into our cached mirror of the base repo
+		async with self.git_cache.mirror(base.repo.full_name, base.repo.html_url) as git_dir:
+			# A mirror that has never been fetched into is cloned by this fetch
+			with metrics.stage_seconds.time('remote_update' if (git_dir / 'FETCH_HEAD').exists() else 'clone'):
+				stats = await self.git_cache.fetch(git_dir, base.ref, payload.pull_request.number, (base.sha, head.sha), shallow=self.shallow)
+
+			metrics.git_fetch_bytes.observe(stats["bytes"], self.name)
+			log.info(
+				f"Fetched {stats['bytes']} bytes for PR #{payload.pull_request.number} in {stats['seconds']:.2f}s",
+				extra={"repository": base.repo.full_name, "pr": payload.pull_request.number, "stage": "fetch", "strategy": self.name, **stats}
+			)
+
+			# The base and head sha of the event, the branches may already have moved on
+			# (and the verdict is cached for exactly these two commits).
+			# The diff is streamed, the consumer matches each batch while git is still
+			# producing the next one, and git is killed if the consumer stops at a match.
+			# Only the time spent waiting on git counts as the diff stage.
+			waited = 0.0
+			async with contextlib.aclosing(self.git_cache.diff(git_dir, base.sha, head.sha)) as file_changes:
+				try:
+					while True:
+						started = time.perf_counter()
+						try:
+							filenames = await anext(file_changes)
+						except StopAsyncIteration:
+							break
+						finally:
+							waited += time.perf_counter() - started
+
+						yield filenames
+				finally:
+					metrics.stage_seconds.observe(waited, 'diff')
+
+class GithubApiProvider:
+	"""
+	Lists the changed files by comparing the base and head commits of the event,
+	following the pages of the comparison. Not the pull request files endpoint,
+	that lists the files of whatever the PR's head is by the time we ask, which
+	may already be a newer push than the one we're verifying (and approving).
+	Renamed files list both the new and the previous name.
+	"""
+	name = 'api'
+	# What the compare endpoint does for base...head
+	comparison = 'merge-base'
+
+	def __init__(self, headers :dict):
+		self.headers = headers
+
+	async def changed_files(self, payload) -> typing.AsyncIterator[list[str]]:
+		base = payload.pull_request.base
+		head = payload.pull_request.head
+		url = f'{github_api.API_URL}/repos/{base.repo.full_name}/compare/{base.sha}...{head.sha}?per_page={API_PAGE_SIZE}'
+
+		while url:
+			with metrics.stage_seconds.time('list_files'):
+				response = await github_api.get(url, self.headers)
+			url = github_api.next_link(response.headers.get('Link'))
+
+			# The pages are pages of commits, GitHub puts the files on the first one
+			if not (files := response.json().get('files')):
+				break
+
+			filenames = []
+			for entry in files:
+				filenames.append(entry['filename'])
+
+				if entry.get('previous_filename'):
+					filenames.append(entry['previous_filename'])
+
+			yield filenames
@@ -8,28 +8,55 @@ except:
 # Leaving for compability for a little longer
 import os
 import re
-import json
 import pathlib
 import pydantic
 import typing
-import urllib.request
+
+from .matcher import ProtectedMatcher
 
 default_config_path = pathlib.Path(r'/etc/github-autorun/github-autorun.toml')
 
+def validate_access_token(value):
+	if not isinstance(value, str):
+		raise ValueError(f"Github access token must be of str type")
+	if len(value) != 93:
+		raise ValueError(f"Github access token should be 93 char long")
+	if not value.startswith('github_'):
+		raise ValueError(f"Github access token must start with 'github_'")
+
+	return value
+
 
 class GithubConfig(pydantic.BaseModel):
 	"""
 	The [github] part of the github-autorun.toml config.
 	It dictates the access token for the GitHub REST API.
 	This is needed for approving runners.
-	The repository helps us verify access on config load,
+	The repository helps us verify access on startup,
 	but also helps us limit PR validation against this repo.
+	More repositories are served by giving them a [repositories."owner/name"]
+	section, the settings here are the defaults for those.
 	"""
 
 	access_token :str = os.environ.get('GITHUB_API_TOKEN', None)
 	repository :str = os.environ.get('GITHUB_REPO', 'Torxed/github-autorun')
 	secret :str|None = os.environ.get('GITHUB_SECRET', None)
 	protected :typing.List[re.Pattern]|None = ["\\.github/.*", "tests/.*"]
+	diff_backend :str = os.environ.get('GITHUB_DIFF_BACKEND', 'auto')
+	api_timeout :float = float(os.environ.get('GITHUB_API_TIMEOUT', "10"))
+	api_max_connections :int = int(os.environ.get('GITHUB_API_MAX_CONNECTIONS', "20"))
+	api_max_keepalive :int = int(os.environ.get('GITHUB_API_MAX_KEEPALIVE', "10"))
+	api_keepalive_expiry :float = float(os.environ.get('GITHUB_API_KEEPALIVE_EXPIRY', "60"))
+	api_parallelism :int = int(os.environ.get('GITHUB_API_PARALLELISM', "8"))
+	api_retries :int = int(os.environ.get('GITHUB_API_RETRIES', "3"))
+	api_retry_backoff :float = float(os.environ.get('GITHUB_API_RETRY_BACKOFF', "0.5"))
+	api_http2 :bool = os.environ.get('GITHUB_API_HTTP2', "true").lower() in ('1', 'true', 'yes')
+	api_rate_limit_reserve :int = int(os.environ.get('GITHUB_API_RATE_LIMIT_RESERVE', "100"))
+	api_rate_limit_retries :int = int(os.environ.get('GITHUB_API_RATE_LIMIT_RETRIES', "3"))
+	api_max_backoff :float = float(os.environ.get('GITHUB_API_MAX_BACKOFF', "900"))
+	api_cache_entries :int = int(os.environ.get('GITHUB_API_CACHE_ENTRIES', "1024"))
+	api_cache_path :pathlib.Path|None = os.environ.get('GITHUB_API_CACHE_PATH', None)
+	api_cache_files :int = int(os.environ.get('GITHUB_API_CACHE_FILES', "10000"))
 
 	@pydantic.field_validator("repository", mode='before')
 	def validate_repo(cls, value):
@@ -38,46 +65,62 @@ class GithubConfig(pydantic.BaseModel):
 
 		return value
 
+	@pydantic.field_validator("diff_backend", mode='before')
+	def validate_diff_backend(cls, value):
+		if value not in ('auto', 'api', 'git', 'shallow', 'full'):
+			raise ValueError(f"diff_backend must be one of 'auto', 'api', 'git', 'shallow' or 'full'")
+
+		return value
+
+	@pydantic.field_validator("access_token", mode='before')
+	def validate_access_token(cls, value):
+		return validate_access_token(value)
+
+class RepositoryConfig(pydantic.BaseModel):
+	"""
+	A [repositories."owner/name"] section of the github-autorun.toml config.
+	Anything left out is taken from the [github] section, the concurrency
+	limits how many PR's of this repository are verified at the same time
+	(defaults to the worker count, so no limit).
+	"""
+
+	access_token :str|None = None
+	protected :typing.List[re.Pattern]|None = None
+	concurrency :int|None = None
+
+	_matcher :ProtectedMatcher = pydantic.PrivateAttr()
+
+	@property
+	def matcher(self) -> ProtectedMatcher:
+		"""
+		The protected rules, compiled into a single matcher on config load.
+		"""
+		return self._matcher
+
 	@pydantic.field_validator("access_token", mode='before')
 	def validate_access_token(cls, value):
-		if not isinstance(value, str):
-			raise ValueError(f"Github access token must be of str type")
-		if len(value) != 93:
-			raise ValueError(f"Github access token should be 93 char long")
-		if not value.startswith('github_'):
-			raise ValueError(f"Github access token must start with 'github_'")
+		if value is None:
+			return value
+
+		return validate_access_token(value)
+
+	@pydantic.field_validator("concurrency", mode='after')
+	def validate_concurrency(cls, value):
+		if value is not None and value < 1:
+			raise ValueError(f"Repository concurrency must be at least 1")
 
 		return value
 
-	@pydantic.model_validator(mode='after')
-	def validate_config(self):
-		headers = {
-			"Accept": "application/vnd.github+json",
-			"Authorization": f"Bearer {self.access_token}",
-			"X-GitHub-Api-Version": "2022-11-28"
-		}
-
-		# /repos/OWNER/REPO - https://docs.github.com/en/rest/repos/repos?apiVersion=2022-11-28#get-a-repository
-		request = urllib.request.Request(
-			f'https://api.github.com/repos/{self.repository}',
-			method="GET",
-			headers=headers
-		)
-		
-		try:
-			with urllib.request.urlopen(request) as response:
-				info = response.info()
-				if info.get_content_subtype() == 'json':
-					repo_info = json.loads(response.read().decode(info.get_content_charset('utf-8')))
-					if repo_info.get('full_name', None) != self.repository:
-						raise PermissionError(f"Could not fetch configured repository info: {self.repository}")
-		except urllib.error.HTTPError as error:
-			if error.code == 401:
-				raise PermissionError(f"Could not use configured access token, potentially it has expired.")
-
-			raise error
+	def inherit(self, github :GithubConfig):
+		"""
+		Fills in what was left out from the [github] section, and compiles the protected rules.
+		"""
+		if self.access_token is None:
+			self.access_token = github.access_token
+		if self.protected is None:
+			self.protected = github.protected
 
-		return self
+		self._matcher = ProtectedMatcher(self.protected or [])
 
 class ApiConfig(pydantic.BaseModel):
 	"""
@@ -89,6 +132,20 @@ class ApiConfig(pydantic.BaseModel):
 	address :str = os.environ.get('API_BIND_ADDR', "127.0.0.1")
 	port :int = int(os.environ.get('API_BIND_PORT', "1337"))
 	log_level :str = os.environ.get('API_LOG_LEVEL', "INFO")
+	# GitHub caps webhook payloads at 25 MB, anything larger is not a delivery
+	max_body_size :int = int(os.environ.get('API_MAX_BODY_SIZE', str(25 * 1024 * 1024)))
+	# Access log lines per second (after a burst), so a flood of deliveries doesn't flood the log. 0 disables the limit.
+	access_log_rate :float = float(os.environ.get('API_ACCESS_LOG_RATE', "50"))
+	access_log_burst :int = int(os.environ.get('API_ACCESS_LOG_BURST', "200"))
+	# Hypercorn worker processes, they share one socket and coordinate through [workers] state_path
+	workers :int = int(os.environ.get('API_WORKERS', "1"))
+	# "asyncio" or "uvloop" (if installed)
+	event_loop :str = os.environ.get('API_EVENT_LOOP', "asyncio")
+	# Redeliveries of a delivery id seen within this many seconds are accepted without verifying again
+	delivery_ttl :int = int(os.environ.get('API_DELIVERY_TTL', "86400"))
+	delivery_entries :int = int(os.environ.get('API_DELIVERY_ENTRIES', "10000"))
+	# Keeps the delivery ids across restarts and shares them between the workers
+	delivery_path :pathlib.Path|None = os.environ.get('API_DELIVERY_PATH', None) # Defaults to deliveries.sqlite3 in [cache] path
 
 	# .. todo::
 	#    Improve validators to also take into account if it's PEM format.
@@ -121,6 +178,65 @@ class ApiConfig(pydantic.BaseModel):
 
 		return value
 
+	@pydantic.field_validator("workers", mode='after')
+	def validate_workers(cls, value):
+		if value < 1:
+			raise ValueError(f"There must be at least 1 API worker")
+
+		return value
+
+	@pydantic.field_validator("event_loop", mode='before')
+	def validate_event_loop(cls, value):
+		if value not in ('asyncio', 'uvloop'):
+			raise ValueError(f"event_loop must be 'asyncio' or 'uvloop'")
+
+		return value
+
+class CacheConfig(pydantic.BaseModel):
+	"""
+	Controls the on-disk mirror cache, which keeps a bare
+	repository around per base repo so that we only need to
+	fetch the new refs for each pull request event.
+	And the cache of verdicts per base/head commit, which
+	lets us skip the fetch altogether for a PR we've seen.
+	"""
+
+	path :pathlib.Path = os.environ.get('CACHE_PATH', '/var/cache/github-autorun')
+	max_size :int = int(os.environ.get('CACHE_MAX_SIZE', "10240")) # MiB
+	gc_interval :int = int(os.environ.get('CACHE_GC_INTERVAL', "86400")) # Seconds
+	decisions_path :pathlib.Path|None = os.environ.get('CACHE_DECISIONS_PATH', None) # Defaults to decisions.sqlite3 in path
+	decision_ttl :int = int(os.environ.get('CACHE_DECISION_TTL', str(30 * 86400))) # Seconds
+	decision_entries :int = int(os.environ.get('CACHE_DECISION_ENTRIES', "100000"))
+
+	@pydantic.field_validator("path", mode='before')
+	def validate_path(cls, value):
+		if not isinstance(value, pathlib.Path):
+			value = pathlib.Path(value)
+
+		return value.expanduser().resolve().absolute()
+
+class WorkerConfig(pydantic.BaseModel):
+	"""
+	Controls the background workers that verify pull requests,
+	and how many pull request events may be queued up for them.
+	"""
+
+	count :int = int(os.environ.get('WORKER_COUNT', "4"))
+	queue_size :int = int(os.environ.get('WORKER_QUEUE_SIZE', "100"))
+	# /readiness reports not ready once the oldest queued PR event has waited this many seconds
+	max_wait :int = int(os.environ.get('WORKER_MAX_WAIT', "300"))
+	# Shared between the API worker processes, defaults to state.sqlite3 in the [cache] path
+	state_path :pathlib.Path|None = os.environ.get('WORKER_STATE_PATH', None)
+	# Seconds a process may verify a PR before another process is allowed to take it over
+	claim_lease :int = int(os.environ.get('WORKER_CLAIM_LEASE', "900"))
+
+	@pydantic.field_validator("count", "queue_size", mode='after')
+	def validate_positive(cls, value):
+		if value < 1:
+			raise ValueError(f"Worker count and queue size must be at least 1")
+
+		return value
+
 class Config(pydantic.BaseModel):
 	"""
 	These are the config headers allowed in the
@@ -129,6 +245,36 @@ class Config(pydantic.BaseModel):
 
 	github :GithubConfig
 	api :ApiConfig
+	cache :CacheConfig = pydantic.Field(default_factory=CacheConfig)
+	workers :WorkerConfig = pydantic.Field(default_factory=WorkerConfig)
+	repositories :typing.Dict[str, RepositoryConfig] = pydantic.Field(default_factory=dict)
+
+	@pydantic.field_validator("repositories", mode='after')
+	def validate_repository_names(cls, value):
+		for full_name in value:
+			owner, _, name = full_name.partition('/')
+			if not owner or not name or '/' in name or '..' in full_name:
+				raise ValueError(f"Repository sections must be named \"owner/name\", got: {full_name}")
+
+		return value
+
+	@pydantic.model_validator(mode='after')
+	def validate_repositories(self):
+		# The [github] repository is always served, with the [github] settings unless it has a section of its own
+		if self.github.repository not in self.repositories:
+			self.repositories[self.github.repository] = RepositoryConfig()
+
+		# Access to the repositories is verified by autorun.access once we're serving
+		for repository in self.repositories.values():
+			repository.inherit(self.github)
+
+		return self
+
+	def repository(self, full_name :str) -> RepositoryConfig|None:
+		"""
+		The settings of a repository we serve, None if we don't serve it.
+		"""
+		return self.repositories.get(full_name)
 
 
 if ((conf_file := default_config_path) if default_config_path.exists() else (conf_file := pathlib.Path('./github-autorun.toml').resolve())).exists():
@@ -0,0 +1,81 @@
+import time
+import logging
+import pathlib
+import sqlite3
+
+from .shared_state import SqliteStore
+
+"""
+A durable cache of verdicts, so that reopened PR's, redeliveries and re-runs
+of the exact same base and head don't clone and diff all over again.
+A verdict is keyed on the repository, the base and head commit, how the two
+were compared (see the providers in changed_files) and the fingerprint of the
+protected rules. Changing the rules changes the fingerprint, which makes every
+verdict made with the old rules miss without having to clear anything.
+"""
+
+log = logging.getLogger()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS decisions (
+	repository TEXT NOT NULL,
+	base TEXT NOT NULL,
+	head TEXT NOT NULL,
+	comparison TEXT NOT NULL,
+	rules TEXT NOT NULL,
+	path TEXT,
+	rule TEXT,
+	created REAL NOT NULL,
+	PRIMARY KEY (repository, base, head, comparison, rules)
+);
+CREATE INDEX IF NOT EXISTS decisions_created ON decisions (created);
+"""
+
+class Decision:
+	"""
+	The protected :code:`path` the PR modified and the :code:`rule` it matched,
+	both None if it didn't modify any protected path.
+	"""
+	def __init__(self, path :str|None, rule :str|None):
+		self.path = path
+		self.rule = rule
+
+	@property
+	def protected(self) -> bool:
+		return self.path is not None
+
+class DecisionCache(SqliteStore):
+	"""
+	Verdicts are kept for :code:`ttl` seconds, and at most :code:`max_entries`
+	of them (the oldest go first).
+	"""
+	schema = SCHEMA
+
+	def __init__(self, path :pathlib.Path, ttl :int, max_entries :int):
+		super().__init__(path)
+		self.ttl = ttl
+		self.max_entries = max_entries
+
+	def get(self, repository :str, base :str, head :str, comparison :str, rules :str) -> Decision|None:
+		row = self._read(
+			"SELECT path, rule FROM decisions WHERE repository = ? AND base = ? AND head = ? AND comparison = ? AND rules = ? AND created >= ?",
+			(repository, base, head, comparison, rules, time.time() - self.ttl)
+		)
+
+		if row is None:
+			return None
+
+		return Decision(*row)
+
+	def put(self, repository :str, base :str, head :str, comparison :str, rules :str, decision :Decision):
+		self._write(lambda connection: connection.execute(
+			"INSERT OR REPLACE INTO decisions (repository, base, head, comparison, rules, path, rule, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+			(repository, base, head, comparison, rules, decision.path, decision.rule, time.time())
+		))
+
+	def prune(self, connection :sqlite3.Connection):
+		connection.execute("DELETE FROM decisions WHERE created < ?", (time.time() - self.ttl,))
+		connection.execute(
+			"DELETE FROM decisions WHERE rowid IN (SELECT rowid FROM decisions ORDER BY created DESC LIMIT -1 OFFSET ?)",
+			(self.max_entries,)
+		)
@@ -0,0 +1,104 @@
+import time
+import asyncio
+import logging
+import pathlib
+import sqlite3
+import collections
+
+from .shared_state import SqliteStore
+
+"""
+Remembers the X-GitHub-Delivery id of the deliveries we've queued, so that
+GitHub's redeliveries (on timeouts, or someone hitting "Redeliver" in the UI)
+are accepted without being verified all over again.
+
+The index lives in memory, ordered by when the delivery was seen, so a lookup
+is a dict lookup and expired ids are dropped from the front. It holds at most
+:code:`max_entries` ids. With a store, the ids are also kept in SQLite so that
+they survive a restart and are shared between the API worker processes.
+"""
+
+log = logging.getLogger()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS deliveries (id TEXT PRIMARY KEY, received REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS deliveries_received ON deliveries (received);
+"""
+
+class DeliveryStore(SqliteStore):
+	schema = SCHEMA
+
+	def __init__(self, path :pathlib.Path, ttl :float, max_entries :int):
+		super().__init__(path)
+		self.ttl = ttl
+		self.max_entries = max_entries
+
+	def prune(self, connection :sqlite3.Connection):
+		connection.execute("DELETE FROM deliveries WHERE received < ?", (time.time() - self.ttl,))
+		connection.execute(
+			"DELETE FROM deliveries WHERE rowid IN (SELECT rowid FROM deliveries ORDER BY received DESC LIMIT -1 OFFSET ?)",
+			(self.max_entries,)
+		)
+
+	def add(self, delivery :str) -> bool:
+		"""
+		Records the delivery, returns False if it was already recorded (and hasn't expired).
+		"""
+		def statements(connection :sqlite3.Connection) -> bool:
+			now = time.time()
+
+			# An expired id is a new delivery as far as we're concerned
+			connection.execute("DELETE FROM deliveries WHERE id = ? AND received < ?", (delivery, now - self.ttl))
+			return connection.execute("INSERT OR IGNORE INTO deliveries (id, received) VALUES (?, ?)", (delivery, now)).rowcount == 1
+
+		return self._write(statements)
+
+	def discard(self, delivery :str):
+		self._write(lambda connection: connection.execute("DELETE FROM deliveries WHERE id = ?", (delivery,)))
+
+class DeliveryIndex:
+	def __init__(self, ttl :float, max_entries :int, store :DeliveryStore|None = None):
+		self.ttl = ttl
+		self.max_entries = max_entries
+		self.store = store
+		# Delivery id to when we saw it, oldest first
+		self._seen :collections.OrderedDict[str, float] = collections.OrderedDict()
+
+	def _expire(self, now :float):
+		while self._seen and (len(self._seen) > self.max_entries or next(iter(self._seen.values())) < now - self.ttl):
+			self._seen.popitem(last=False)
+
+	async def add(self, delivery :str) -> bool:
+		"""
+		Records the delivery, returns False if it's a duplicate of one we've already seen.
+		"""
+		now = time.monotonic()
+		self._expire(now)
+
+		if delivery in self._seen:
+			return False
+
+		# Another process, or this one before a restart, may have seen it
+		if self.store is not None and not await asyncio.to_thread(self.store.add, delivery):
+			return False
+
+		self._seen[delivery] = now
+		self._expire(now)
+
+		return True
+
+	async def discard(self, delivery :str):
+		"""
+		Forgets the delivery, so that a redelivery of it is processed.
+		"""
+		self._seen.pop(delivery, None)
+
+		if self.store is not None:
+			await asyncio.to_thread(self.store.discard, delivery)
+
+	def close(self):
+		if self.store is not None:
+			self.store.close()
+
+	def __len__(self) -> int:
+		return len(self._seen)
@@ -0,0 +1,365 @@
+import os
+import time
+import fcntl
+import shutil
+import asyncio
+import logging
+import pathlib
+import contextlib
+import subprocess
+import typing
+
+"""
+A managed on-disk cache of bare mirrors, one per base repository.
+Instead of cloning the whole repository for every pull request event,
+we keep the mirror around and only fetch the refs we need to diff.
+The PR head is fetched from the base repository's refs/pull/<number>/head,
+so the contributor's fork is never touched (and may even be deleted).
+Mirrors are partial clones without blobs, a name-only diff only needs
+the commits and their trees.
+"""
+
+log = logging.getLogger()
+
+# Below this much free disk space the cache is reported as unhealthy, as a clone would likely fail
+MIN_FREE_SPACE = 100 * 1024 * 1024
+# Bytes read from a streaming git command at a time, each read becomes one batch of records
+STREAM_CHUNK_SIZE = 64 * 1024
+
+async def git(*args :str, cwd :pathlib.Path|None = None) -> subprocess.CompletedProcess:
+	"""
+	Runs git without a shell, the arguments are passed as-is.
+	The process is run as an asyncio subprocess so that the event loop keeps serving requests.
+	"""
+	process = await asyncio.create_subprocess_exec(
+		'git', *args,
+		stdout=asyncio.subprocess.PIPE,
+		stderr=asyncio.subprocess.PIPE,
+		cwd=cwd
+	)
+	stdout, stderr = await process.communicate()
+
+	return subprocess.CompletedProcess(['git', *args], process.returncode, stdout, stderr)
+
+async def git_stream(*args :str, cwd :pathlib.Path|None = None) -> typing.AsyncIterator[list[bytes]]:
+	"""
+	Runs git like :code:`git()`, but yields its NUL separated output (the :code:`-z` format)
+	in batches of records as it's being read, so the output is never held in memory as a whole.
+	If the consumer stops early (closes the generator), git is killed instead of left to finish.
+	Raises CalledProcessError if git fails.
+	"""
+	process = await asyncio.create_subprocess_exec(
+		'git', *args,
+		stdout=asyncio.subprocess.PIPE,
+		stderr=asyncio.subprocess.PIPE,
+		cwd=cwd
+	)
+	# Read alongside stdout, a git blocked on writing to a full stderr pipe would never finish stdout
+	errors = asyncio.create_task(process.stderr.read())
+
+	try:
+		partial = b''
+		while chunk := await process.stdout.read(STREAM_CHUNK_SIZE):
+			# The last record is cut off mid-way, unless the chunk happened to end on a NUL
+			*records, partial = (partial + chunk).split(b'\0')
+
+			if records:
+				yield records
+
+		if partial:
+			yield [partial]
+
+		if await process.wait() != 0:
+			raise subprocess.CalledProcessError(process.returncode, ['git', *args], stderr=await errors)
+	finally:
+		if process.returncode is None:
+			log.debug(f"Stopping git {args[0]} early")
+			process.kill()
+			await process.wait()
+
+		errors.cancel()
+
+class MirrorCache:
+	"""
+	Keeps a bare mirror for each base repository under :code:`path`.
+	Each mirror is guarded by its own lock so that concurrent deliveries
+	for the same repository don't step on each others fetches. The API worker
+	processes share the cache, so the lock is an flock() on a lock file next
+	to the mirror (with an asyncio.Lock in front, to not tie up a thread per waiting delivery).
+	When the cache grows past :code:`max_size` (MiB) the least recently
+	used mirrors are evicted, and every mirror gets a :code:`git gc` at most
+	once every :code:`gc_interval` seconds. Both happen in a background task
+	after a mirror has been used, so no verification waits on them.
+	"""
+	def __init__(self, path :pathlib.Path, max_size :int, gc_interval :int):
+		self.path = path
+		self.max_size = max_size * 1024 * 1024
+		self.gc_interval = gc_interval
+		self._locks :dict[str, asyncio.Lock] = {}
+		self._maintenance :dict[str, asyncio.Task] = {}
+
+	def mirror_path(self, full_name :str) -> pathlib.Path:
+		# full_name is validated to not contain '..', so flattening the
+		# owner/repo slash is enough to keep it inside the cache directory.
+		return self.path / f"{full_name.replace('/', '__')}.git"
+
+	def lock_path(self, git_dir :pathlib.Path) -> pathlib.Path:
+		# Outside of the mirror, so it outlives an eviction and can't be deleted while someone waits on it
+		return git_dir.with_name(f"{git_dir.name}.lock")
+
+	def lock(self, full_name :str) -> asyncio.Lock:
+		if (lock := self._locks.get(full_name)) is None:
+			lock = self._locks[full_name] = asyncio.Lock()
+
+		return lock
+
+	def flock(self, git_dir :pathlib.Path, blocking :bool = True) -> int|None:
+		"""
+		Takes the lock shared with the other processes, returns the file descriptor
+		holding it (to :code:`unlock()` later) or None if :code:`blocking` is False and it's taken.
+		"""
+		self.path.mkdir(parents=True, exist_ok=True)
+		fd = os.open(self.lock_path(git_dir), os.O_RDWR | os.O_CREAT, 0o644)
+
+		try:
+			fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except BlockingIOError:
+			os.close(fd)
+			return None
+		except BaseException:
+			os.close(fd)
+			raise
+
+		return fd
+
+	def unlock(self, fd :int):
+		fcntl.flock(fd, fcntl.LOCK_UN)
+		os.close(fd)
+
+	async def acquire(self, git_dir :pathlib.Path) -> int:
+		"""
+		Waits for the lock in a thread. The thread can't be cancelled, so if we are
+		cancelled while it waits, the lock is released as soon as the thread gets it.
+		"""
+		waiting = asyncio.ensure_future(asyncio.to_thread(self.flock, git_dir))
+
+		try:
+			return await asyncio.shield(waiting)
+		except asyncio.CancelledError:
+			waiting.add_done_callback(lambda done: done.cancelled() or done.exception() is not None or self.unlock(done.result()))
+			raise
+
+	@contextlib.asynccontextmanager
+	async def mirror(self, full_name :str, url :str):
+		"""
+		Yields the path to the bare mirror of :code:`full_name`,
+		creating it if it does not yet exist. The mirror is locked
+		(against this and the other processes) for the duration of the context,
+		which covers the fetch and the diff.
+		"""
+		try:
+			async with self.lock(full_name):
+				git_dir = self.mirror_path(full_name)
+				fd = await self.acquire(git_dir)
+
+				try:
+					# Checked once we hold the lock, another process may just have created or evicted it
+					if not git_dir.exists():
+						log.debug(f"Creating mirror for {full_name} in {git_dir}")
+						await git('init', '-q', '--bare', str(git_dir))
+						await git('remote', 'add', 'origin', '--', url, cwd=git_dir)
+
+					# The modification time of the mirror is what we use for LRU eviction
+					os.utime(git_dir)
+
+					yield git_dir
+				finally:
+					self.unlock(fd)
+		finally:
+			# Also when the diff was stopped early, at a protected file
+			self.schedule_maintenance(full_name)
+
+	def schedule_maintenance(self, full_name :str):
+		"""
+		Starts :code:`maintain()` for the mirror in the background, unless it's already running.
+		"""
+		if (task := self._maintenance.get(full_name)) is None or task.done():
+			self._maintenance[full_name] = asyncio.create_task(self.maintain(full_name))
+
+	async def maintain(self, full_name :str):
+		"""
+		Runs a :code:`git gc` on the mirror if it's due, taking the mirror's lock only
+		for the gc itself, and then evicts mirrors if the cache has grown too big.
+		"""
+		git_dir = self.mirror_path(full_name)
+
+		try:
+			if self.gc_due(git_dir):
+				async with self.lock(full_name):
+					fd = await self.acquire(git_dir)
+
+					try:
+						# Checked again under the lock, another process may have done it (or evicted the mirror) meanwhile
+						if git_dir.exists() and self.gc_due(git_dir):
+							await self.gc(git_dir)
+					finally:
+						self.unlock(fd)
+
+			await asyncio.to_thread(self.evict)
+		except Exception as error:
+			log.exception(f"Could not maintain the mirror of {full_name}: {error}")
+
+	async def stop(self):
+		for task in self._maintenance.values():
+			task.cancel()
+
+		await asyncio.gather(*self._maintenance.values(), return_exceptions=True)
+
+	def is_complete(self, full_name :str) -> bool:
+		"""
+		Whether we hold a mirror of :code:`full_name` with full history,
+		in which case fetching into it is incremental and cheap.
+		"""
+		return self.has_history(self.mirror_path(full_name))
+
+	def has_history(self, git_dir :pathlib.Path) -> bool:
+		# A mirror that was never fetched into has nothing yet, a shallow one only the tips
+		return (git_dir / 'FETCH_HEAD').exists() and not (git_dir / 'shallow').exists()
+
+	def packs(self, git_dir :pathlib.Path) -> dict[str, int]:
+		pack_dir = git_dir / 'objects' / 'pack'
+		if not pack_dir.exists():
+			return {}
+
+		return {entry.name: entry.stat().st_size for entry in os.scandir(pack_dir) if entry.name.endswith('.pack')}
+
+	async def fetch(self, git_dir :pathlib.Path, base_ref :str, number :int, commits :typing.Sequence[str] = (), shallow :bool = False) -> dict:
+		"""
+		Fetches the base branch and the pull request head into the mirror, in one go,
+		along with the :code:`commits` (sha's) we're about to diff. The branches may
+		have moved on since the event was sent, the commits are exactly what it was about.
+		Blobs are never fetched. A shallow fetch only grabs the tip commits,
+		a full fetch keeps the history (unshallowing the mirror if needed) which
+		makes the next fetch into it incremental. A mirror with the full history is
+		never made shallow, the fetch into it is incremental either way.
+
+		Returns how many pack bytes were received and how long it took.
+		"""
+		if shallow and not self.has_history(git_dir):
+			options = ['--depth=1']
+		elif (git_dir / 'shallow').exists():
+			options = ['--unshallow']
+		else:
+			options = []
+
+		# Keep what's received as a pack (instead of loose objects), so its size is what went over the wire
+		before = self.packs(git_dir)
+		started = time.perf_counter()
+
+		log.debug(f"git fetch origin {base_ref} and pull/{number}/head into {git_dir}")
+		result = await git(
+			'-c', 'fetch.unpackLimit=1',
+			'fetch', '-q', '--no-tags', '--filter=blob:none', *options, 'origin',
+			f"+refs/heads/{base_ref}:refs/remotes/origin/{base_ref}",
+			f"+refs/pull/{number}/head:refs/pull/{number}/head",
+			*commits,
+			cwd=git_dir
+		)
+		if result.returncode != 0:
+			log.warning(f"git fetch into {git_dir} failed: {result.stderr.decode(errors='replace').strip()}")
+			result.check_returncode()
+
+		after = self.packs(git_dir)
+
+		return {
+			"bytes": sum(size for name, size in after.items() if name not in before),
+			"seconds": time.perf_counter() - started,
+		}
+
+	async def diff(self, git_dir :pathlib.Path, base :str, head :str) -> typing.AsyncIterator[list[str]]:
+		"""
+		Streams the files that differ between the :code:`base` and :code:`head` commits, in batches.
+		The names are NUL separated (-z), so names with newlines in them come out whole,
+		and unquoted. Rename detection is turned off, as it would need the blobs
+		(which we don't fetch) and we want both the old and new name of a moved file anyway.
+		"""
+		try:
+			async for records in git_stream('diff', '-z', '--name-only', '--no-renames', '--end-of-options', base, head, '--', cwd=git_dir):
+				yield [record.decode(errors='replace') for record in records]
+		except subprocess.CalledProcessError as error:
+			log.warning(f"git diff in {git_dir} failed: {error.stderr.decode(errors='replace').strip()}")
+			raise
+
+	def gc_due(self, git_dir :pathlib.Path) -> bool:
+		marker = git_dir / 'autorun-last-gc'
+
+		try:
+			return time.time() - marker.stat().st_mtime >= self.gc_interval
+		except FileNotFoundError:
+			return git_dir.exists()
+
+	async def gc(self, git_dir :pathlib.Path):
+		log.debug(f"Running git gc on {git_dir}")
+		await git('gc', '--quiet', cwd=git_dir)
+		(git_dir / 'autorun-last-gc').touch()
+
+	def health(self) -> dict:
+		"""
+		A cheap look at the cache, for the readiness probe. Only stats the
+		cache directory and the filesystem it lives on, mirrors are never walked.
+		"""
+		# The directory is created on the first mirror, until then it's the parent we'd write to
+		directory = self.path if self.path.exists() else self.path.parent
+		writable = os.access(directory, os.W_OK)
+
+		try:
+			free = shutil.disk_usage(directory).free
+		except OSError:
+			free = 0
+
+		return {
+			"path": str(self.path),
+			"writable": writable,
+			"free_bytes": free,
+			"mirrors_in_use": sum(1 for lock in self._locks.values() if lock.locked()),
+			"healthy": writable and free >= MIN_FREE_SPACE,
+		}
+
+	def size(self, git_dir :pathlib.Path) -> int:
+		total = 0
+		for root, dirs, files in os.walk(git_dir):
+			for name in files:
+				with contextlib.suppress(FileNotFoundError):
+					total += os.lstat(os.path.join(root, name)).st_size
+
+		return total
+
+	def evict(self):
+		"""
+		Removes the least recently used mirrors until the cache fits within :code:`max_size`.
+		Mirrors that are currently locked (by any process) are never evicted.
+		"""
+		if not self.path.exists():
+			return
+
+		mirrors = sorted(
+			(git_dir for git_dir in self.path.glob('*.git') if git_dir.is_dir()),
+			key=lambda git_dir: git_dir.stat().st_mtime
+		)
+		sizes = {git_dir: self.size(git_dir) for git_dir in mirrors}
+		total = sum(sizes.values())
+
+		for git_dir in mirrors:
+			if total <= self.max_size:
+				break
+
+			if (fd := self.flock(git_dir, blocking=False)) is None:
+				continue
+
+			try:
+				log.info(f"Evicting mirror {git_dir} from the cache ({sizes[git_dir]} bytes)")
+				shutil.rmtree(git_dir, ignore_errors=True)
+			finally:
+				self.unlock(fd)
+
+			total -= sizes[git_dir]
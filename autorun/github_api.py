@@ -0,0 +1,186 @@
+import re
+import asyncio
+import logging
+import importlib.util
+import httpx
+
+from . import metrics
+from .http_cache import ResponseCache
+from .rate_limit import Priority, RateLimitScheduler, is_rate_limited
+
+"""
+Helpers for calling the GitHub REST API without blocking the event loop.
+All calls share one pooled keep-alive client, so that we don't pay for
+a TLS handshake to api.github.com on every approval. Responses are
+decompressed transparently by httpx (gzip and deflate, brotli if installed).
+Each access token has a rate limit budget of its own, so each gets its own
+scheduler, picked by the Authorization header of the call.
+"""
+
+log = logging.getLogger()
+
+API_URL = 'https://api.github.com'
+
+LINK_NEXT = re.compile(r'<([^>]+)>;\s*rel="next"')
+
+_client :httpx.AsyncClient|None = None
+_cache :ResponseCache|None = None
+# Per Authorization header
+_schedulers :dict[str, RateLimitScheduler] = {}
+
+def next_link(link_header :str|None) -> str|None:
+	"""
+	Returns the rel="next" URL from a GitHub pagination Link header, if any.
+	"""
+	if link_header and (match := LINK_NEXT.search(link_header)):
+		return match.group(1)
+
+	return None
+
+def client_options(github_config) -> dict:
+	"""
+	The connection pool, timeout and protocol options for a client,
+	taken from the [github] section of the config.
+	"""
+	return {
+		"limits": httpx.Limits(
+			max_connections=github_config.api_max_connections,
+			max_keepalive_connections=github_config.api_max_keepalive,
+			keepalive_expiry=github_config.api_keepalive_expiry
+		),
+		"timeout": httpx.Timeout(github_config.api_timeout),
+		# HTTP/2 is only available if the optional h2 package is installed
+		"http2": github_config.api_http2 and importlib.util.find_spec('h2') is not None,
+	}
+
+def get_client() -> httpx.AsyncClient:
+	global _client
+
+	if _client is None:
+		# Imported here, so that this module can be imported without loading the config
+		from .config import config
+
+		_client = httpx.AsyncClient(**client_options(config.github))
+
+	return _client
+
+def get_cache(github_config) -> ResponseCache:
+	global _cache
+
+	if _cache is None:
+		_cache = ResponseCache(github_config.api_cache_entries, github_config.api_cache_path, github_config.api_cache_files)
+
+	return _cache
+
+def authorization(access_token :str) -> str:
+	return f"Bearer {access_token}"
+
+def get_scheduler(headers :dict) -> RateLimitScheduler:
+	"""
+	The scheduler of the access token the call is made with.
+	"""
+	key = headers.get('Authorization', '')
+
+	if (scheduler := _schedulers.get(key)) is None:
+		from .config import config
+
+		scheduler = _schedulers[key] = RateLimitScheduler(config.github.api_rate_limit_reserve, config.github.api_max_backoff)
+
+	return scheduler
+
+def budgets() -> dict[str, dict]:
+	"""
+	The rate limit budget of each configured access token, by the repositories using it
+	(the tokens themselves are not something to show on an endpoint).
+	"""
+	from .config import config
+
+	repositories :dict[str, list[str]] = {}
+	for full_name, repository in config.repositories.items():
+		repositories.setdefault(repository.access_token, []).append(full_name)
+
+	return {
+		','.join(sorted(full_names)): get_scheduler({"Authorization": authorization(access_token)}).budget()
+		for access_token, full_names in repositories.items()
+	}
+
+async def close():
+	global _client
+
+	if _client is not None:
+		await _client.aclose()
+		_client = None
+
+def is_transient(error :httpx.HTTPError) -> bool:
+	"""
+	Whether a failed call is worth retrying: network trouble, GitHub being busy,
+	or a rate limit that outlasted the backoffs in send().
+	"""
+	if isinstance(error, httpx.TransportError):
+		return True
+
+	if isinstance(error, httpx.HTTPStatusError):
+		return error.response.status_code >= 500 or is_rate_limited(error.response)
+
+	return False
+
+async def send(method :str, url :str, headers :dict, priority :Priority) -> httpx.Response:
+	"""
+	Sends a call through the rate limit scheduler, and retries it
+	(a bounded number of times) when GitHub asks us to back off.
+	"""
+	from .config import config
+
+	scheduler = get_scheduler(headers)
+
+	for attempt in range(config.github.api_rate_limit_retries + 1):
+		await scheduler.acquire(priority)
+
+		try:
+			response = await get_client().request(method, url, headers=headers)
+		except httpx.TransportError:
+			metrics.github_api_requests.inc(method, 'error')
+			raise
+
+		metrics.github_api_requests.inc(method, response.status_code)
+		scheduler.update(response)
+
+		if attempt == config.github.api_rate_limit_retries or (delay := scheduler.backoff(response, attempt)) is None:
+			break
+
+		await asyncio.sleep(delay)
+
+	return response
+
+async def request(method :str, url :str, headers :dict, priority :Priority = Priority.HIGH) -> httpx.Response:
+	"""
+	Performs a single GitHub API call and raises on any non 2xx response.
+	"""
+	response = await send(method, url, headers, priority)
+
+	response.raise_for_status()
+	return response
+
+async def get(url :str, headers :dict, priority :Priority = Priority.LOW) -> httpx.Response:
+	"""
+	A GET that revalidates any cached response with conditional headers,
+	a 304 from GitHub is returned as the cached 200 response.
+	"""
+	from .config import config
+
+	cache = get_cache(config.github)
+	# The on-disk layer is read and written in a thread, to not block the event loop
+	if cache.path:
+		entry = await asyncio.to_thread(cache.get, url)
+	else:
+		entry = cache.get(url)
+
+	response = await send("GET", url, {**headers, **cache.conditional_headers(entry)}, priority)
+
+	if cache.path:
+		response = await asyncio.to_thread(cache.resolve, url, entry, response)
+	else:
+		response = cache.resolve(url, entry, response)
+
+	response.raise_for_status()
+	return response
@@ -1,8 +1,8 @@
+import re
 import enum
 import pydantic
 import typing
 import datetime
-import string
 
 """
 The three main models:
@@ -10,11 +10,63 @@ The three main models:
  * PullRequest
  * WorkflowJob
 
-Those are the entry points used by FastAPI.
+Those are the webhook payloads, picked by parse_event() from the X-GitHub-Event header.
 The rest are just fillers to accomodate the data sent by:
  * https://github.com/<owner>/<repo>/settings/hooks/
 """
 
+# Technically, there are other characters than these that are valid in names and refs.
+# But for our purposes these are the ones we should encouter, and none of them
+# can break out of a git argument or a log line (no quotes, no newlines).
+NAME_CHARACTERS = re.compile(r'[A-Za-z0-9\-_./ ()]*')
+REF_CHARACTERS = re.compile(r'[A-Za-z0-9\-_/@]*')
+# Commit sha's are passed to git as revisions and to the API in query strings
+SHA_CHARACTERS = re.compile(r'[0-9a-f]{40}')
+
+def name_validator(kind :str) -> typing.Callable[[typing.Any], typing.Any]:
+	"""
+	Creates a validator for names of the given kind (repository, job etc),
+	the character class is compiled once and shared by all of them.
+	"""
+	def validate_name(value):
+		if isinstance(value, str) and (NAME_CHARACTERS.fullmatch(value) is None or '..' in value):
+			raise ValueError(f"{kind} name {value} is not a valid name")
+
+		return value
+
+	return validate_name
+
+def validate_html_url(value):
+	if isinstance(value, str):
+		if not value.startswith('https://'):
+			raise ValueError(f"Invalid URL format: {value}")
+		if '..' in value:
+			raise ValueError(f"URL {value} must not contain double dots")
+		if '"' in value:
+			raise ValueError(f"URL {value} must not contain quotations")
+
+	return value
+
+def validate_ref(value):
+	if isinstance(value, str) and REF_CHARACTERS.fullmatch(value) is None:
+		raise ValueError(f"ref value {value} is not a valid git ref format - https://www.git-scm.com/docs/git-check-ref-format")
+
+	return value
+
+def validate_sha(value):
+	if isinstance(value, str) and SHA_CHARACTERS.fullmatch(value) is None:
+		raise ValueError(f"sha {value!r} is not a 40 character hex commit sha")
+
+	return value
+
+HookName = typing.Annotated[str, pydantic.BeforeValidator(name_validator("hook"))]
+RepositoryName = typing.Annotated[str, pydantic.BeforeValidator(name_validator("repository"))]
+JobName = typing.Annotated[str, pydantic.BeforeValidator(name_validator("job"))]
+JobStepName = typing.Annotated[str, pydantic.BeforeValidator(name_validator("job step"))]
+HtmlUrl = typing.Annotated[str, pydantic.BeforeValidator(validate_html_url)]
+GitRef = typing.Annotated[str, pydantic.BeforeValidator(validate_ref)]
+CommitSha = typing.Annotated[str, pydantic.BeforeValidator(validate_sha)]
+
 class Types(enum.Enum):
 	Repository :"Repository"
 
@@ -38,7 +90,7 @@ class LastResponse(pydantic.BaseModel):
 class Hook(pydantic.BaseModel):
 	type :str #Types
 	id :int
-	name :str
+	name :HookName
 	events :typing.List[str]
 	config :WebhookConfig
 	updated_at :datetime.datetime
@@ -49,19 +101,6 @@ class Hook(pydantic.BaseModel):
 	deliveries_url :str
 	last_response :LastResponse
 
-	@pydantic.field_validator("name", mode='before')
-	def validate_name(cls, value):
-		if set(value) - set(string.ascii_letters + string.digits + '-_./ ()'):
-			# Technically, there are other characters than those above
-			# that are valid for hook names. But for our purposes these are the ones we should encouter.
-			raise ValueError(f"hook name {value} is not a valid name")
-		if '..' in value:
-			raise ValueError(f"hook name {value} is not a valid name")
-		if '"' in value:
-			raise ValueError(f"hook name {value} is not a valid name")
-
-		return value
-
 class UserInfo(pydantic.BaseModel):
 	login :str
 	id :int
@@ -69,7 +108,7 @@ class UserInfo(pydantic.BaseModel):
 	avatar_url :str
 	gravatar_id :str
 	url :str
-	html_url :str
+	html_url :HtmlUrl
 	followers_url :str
 	following_url :str
 	gists_url :str
@@ -82,25 +121,14 @@ class UserInfo(pydantic.BaseModel):
 	type :str
 	site_admin :bool
 
-	@pydantic.field_validator("html_url", mode='before')
-	def validate_html_url(cls, value):
-		if not value.startswith('https://'):
-			raise ValueError(f"Invalid URL format: {value}")
-		if '..' in value:
-			raise ValueError(f"URL {value} must not contain double dots")
-		if '"' in value:
-			raise ValueError(f"URL {value} must not contain quotations")
-
-		return value
-
 class Repository(pydantic.BaseModel):
 	id :int
 	node_id :str
-	name :str
-	full_name :str
+	name :RepositoryName
+	full_name :RepositoryName
 	private :bool
 	owner :UserInfo
-	html_url :str
+	html_url :HtmlUrl
 	description :str
 	fork :bool
 	url :str
@@ -181,39 +209,15 @@ class Repository(pydantic.BaseModel):
 	default_branch :str
 	mirror_url :str|None = None
 
-	@pydantic.field_validator("html_url", mode='before')
-	def validate_html_url(cls, value):
-		if not value.startswith('https://'):
-			raise ValueError(f"Invalid URL format: {value}")
-		if '..' in value:
-			raise ValueError(f"URL {value} must not contain double dots")
-		if '"' in value:
-			raise ValueError(f"URL {value} must not contain quotations")
-
-		return value
-
-	@pydantic.field_validator("name", "full_name", mode='before')
-	def validate_name(cls, value):
-		if set(value) - set(string.ascii_letters + string.digits + '-_./ ()'):
-			# Technically, there are other characters than those above
-			# that are valid for repository names. But for our purposes these are the ones we should encouter.
-			raise ValueError(f"repository name {value} is not a valid name")
-		if '..' in value:
-			raise ValueError(f"repository name {value} is not a valid name")
-		if '"' in value:
-			raise ValueError(f"repository name {value} is not a valid name")
-
-		return value
-
 class RepoInfo(pydantic.BaseModel):
 	id :int
 	node_id :str
-	name :str
-	full_name :str
+	name :RepositoryName
+	full_name :RepositoryName
 	private :bool
 	owner :UserInfo
 	fork :bool
-	html_url :str
+	html_url :HtmlUrl
 	description :str
 	url :str
 	forks_url :str
@@ -253,71 +257,23 @@ class RepoInfo(pydantic.BaseModel):
 	releases_url :str
 	deployments_url :str
 
-	@pydantic.field_validator("html_url", mode='before')
-	def validate_html_url(cls, value):
-		if not value.startswith('https://'):
-			raise ValueError(f"Invalid URL format: {value}")
-		if '..' in value:
-			raise ValueError(f"URL {value} must not contain double dots")
-		if '"' in value:
-			raise ValueError(f"URL {value} must not contain quotations")
-
-		return value
-
-	@pydantic.field_validator("name", "full_name", mode='before')
-	def validate_name(cls, value):
-		if set(value) - set(string.ascii_letters + string.digits + '-_./ ()'):
-			# Technically, there are other characters than those above
-			# that are valid for repository names. But for our purposes these are the ones we should encouter.
-			raise ValueError(f"repository name {value} is not a valid name")
-		if '..' in value:
-			raise ValueError(f"repository name {value} is not a valid name")
-		if '"' in value:
-			raise ValueError(f"repository name {value} is not a valid name")
-
-		return value
-
-
 class RepoShort(pydantic.BaseModel):
 	id :int
 	url :str
-	name :str
-
-	@pydantic.field_validator("name", mode='before')
-	def validate_name(cls, value):
-		if set(value) - set(string.ascii_letters + string.digits + '-_./ ()'):
-			# Technically, there are other characters than those above
-			# that are valid for repository names. But for our purposes these are the ones we should encouter.
-			raise ValueError(f"repository name {value} is not a valid name")
-		if '..' in value:
-			raise ValueError(f"repository name {value} is not a valid name")
-		if '"' in value:
-			raise ValueError(f"repository name {value} is not a valid name")
-
-		return value
-
+	name :RepositoryName
 
 class Head(pydantic.BaseModel):
-	ref :str
-	sha :str
+	ref :GitRef
+	sha :CommitSha
 	repo :Repository|RepoShort
 	label :str|None = None
 	user :UserInfo | None = None
 
-	@pydantic.field_validator("ref", mode='before')
-	def validate_ref(cls, value):
-		if set(value) - set(string.ascii_letters + string.digits + '-_/@'):
-			# Technically, there are other characters than those above
-			# that are valid. But for our purposes these are the ones we should encouter.
-			raise ValueError(f"ref value {value} is not a valid git ref format - https://www.git-scm.com/docs/git-check-ref-format")
-		return value
-
-
 class PullRequestInfo(pydantic.BaseModel):
 	url :str
 	id :int
 	node_id :str
-	html_url :str
+	html_url :HtmlUrl
 	diff_url :str
 	patch_url :str
 	issue_url :str
@@ -363,17 +319,6 @@ class PullRequestInfo(pydantic.BaseModel):
 	assignee :str|None = None
 	milestone :str|None = None
 
-	@pydantic.field_validator("html_url", mode='before')
-	def validate_html_url(cls, value):
-		if not value.startswith('https://'):
-			raise ValueError(f"Invalid URL format: {value}")
-		if '..' in value:
-			raise ValueError(f"URL {value} must not contain double dots")
-		if '"' in value:
-			raise ValueError(f"URL {value} must not contain quotations")
-
-		return value
-
 class Ping(pydantic.BaseModel):
 	hook_id :int
 	hook :Hook
@@ -390,6 +335,50 @@ class PullRequest(pydantic.BaseModel):
 	before :str|None = None
 	after :str|None = None
 
+class SlimRepository(pydantic.BaseModel):
+	"""
+	The parts of Repository the verification pipeline uses,
+	the rest of the payload is ignored instead of validated.
+	"""
+	name :RepositoryName
+	full_name :RepositoryName
+	html_url :HtmlUrl
+	size :int|None = None
+
+class SlimHead(pydantic.BaseModel):
+	ref :GitRef
+	sha :CommitSha
+	# None when the fork the PR was made from has been deleted
+	repo :SlimRepository|None = None
+
+class SlimBase(SlimHead):
+	repo :SlimRepository
+
+class SlimPullRequestInfo(pydantic.BaseModel):
+	number :int
+	title :str = ''
+	head :SlimHead
+	base :SlimBase
+	commits :int = 0
+	additions :int = 0
+	deletions :int = 0
+	changed_files :int = 0
+	# Bumped by every push, tells an old (re)delivery from a new one
+	updated_at :datetime.datetime|None = None
+
+class SlimPullRequest(pydantic.BaseModel):
+	"""
+	The pull_request webhook payload as used on the hot path, see PullRequest for the full payload.
+	"""
+	action :str
+	number :int
+	pull_request :SlimPullRequestInfo
+	# The head before and after the push, on synchronize events
+	before :CommitSha|None = None
+	after :CommitSha|None = None
+	# The X-GitHub-Delivery header of the webhook, set after parsing (it's not part of the body)
+	delivery :str|None = pydantic.Field(default=None, exclude=True)
+
 class Author(pydantic.BaseModel):
 	name :str
 	email :str
@@ -411,7 +400,7 @@ class PRInfo(pydantic.BaseModel):
 
 class GithubJobEntry(pydantic.BaseModel):
 	id :int
-	name :str
+	name :JobName
 	node_id :str
 	head_branch :str
 	head_sha :str
@@ -421,7 +410,7 @@ class GithubJobEntry(pydantic.BaseModel):
 	status :str
 	check_suite_node_id :str
 	url :str
-	html_url :str
+	html_url :HtmlUrl
 	created_at :str
 	updated_at :str
 	run_number :int
@@ -446,70 +435,55 @@ class GithubJobEntry(pydantic.BaseModel):
 	conclusion :str|None = None
 	previous_attempt_url :str|None = None
 
-	@pydantic.field_validator("html_url", mode='before')
-	def validate_html_url(cls, value):
-		if not value.startswith('https://'):
-			raise ValueError(f"Invalid URL format: {value}")
-		if '..' in value:
-			raise ValueError(f"URL {value} must not contain double dots")
-		if '"' in value:
-			raise ValueError(f"URL {value} must not contain quotations")
-
-		return value
+class GithubJobs(pydantic.BaseModel):
+	total_count :int
+	workflow_runs :typing.List[GithubJobEntry]
 
-	@pydantic.field_validator("name", mode='before')
-	def validate_name(cls, value):
-		if set(value) - set(string.ascii_letters + string.digits + '-_./ ()'):
-			# Technically, there are other characters than those above
-			# that are valid for job names. But for our purposes these are the ones we should encouter.
-			raise ValueError(f"job name {value} is not a valid name")
-		if '..' in value:
-			raise ValueError(f"job name {value} is not a valid name")
-		if '"' in value:
-			raise ValueError(f"job name {value} is not a valid name")
+class RunPullRequest(pydantic.BaseModel):
+	number :int
 
-		return value
+class WorkflowRun(pydantic.BaseModel):
+	"""
+	A lightweight version of GithubJobEntry, with only the fields we
+	need to approve or cancel a run. Everything else in the entry is ignored.
+	"""
+	id :int
+	name :JobName
+	status :str
+	head_sha :str
+	display_title :str = ''
+	pull_requests :typing.List[RunPullRequest] = []
 
-class GithubJobs(pydantic.BaseModel):
+class WorkflowRuns(pydantic.BaseModel):
+	"""
+	One page of /actions/runs
+	"""
 	total_count :int
-	workflow_runs :typing.List[GithubJobEntry]
+	workflow_runs :typing.List[WorkflowRun]
 
 class JobStep(pydantic.BaseModel):
-	name :str
+	name :JobStepName
 	status :str
 	number :int
 	started_at :datetime.datetime|None = None
 	completed_at :datetime.datetime|None = None
 	conclusion :str|None = None
 
-	@pydantic.field_validator("name", mode='before')
-	def validate_name(cls, value):
-		if set(value) - set(string.ascii_letters + string.digits + '-_./ ()'):
-			# Technically, there are other characters than those above
-			# that are valid for job step names. But for our purposes these are the ones we should encouter.
-			raise ValueError(f"job step name {value} is not a valid name")
-		if '..' in value:
-			raise ValueError(f"job step name {value} is not a valid name")
-		if '"' in value:
-			raise ValueError(f"job step name {value} is not a valid name")
-
-		return value
-
 class WorkflowJobInfo(pydantic.BaseModel):
 	id :int
 	run_id :int
 	run_attempt :int
-	workflow_name :str
+	workflow_name :JobName
 	head_branch :str
 	run_url :str
 	node_id :str
 	head_sha :str
 	url :str
-	html_url :str
+	html_url :HtmlUrl
 	status :str
 	created_at :str
 	started_at :str
-	name :str
+	name :JobName
 	steps :typing.List[JobStep]
 	check_run_url :str
 	labels :typing.List[str]
@@ -520,32 +494,24 @@ class WorkflowJobInfo(pydantic.BaseModel):
 	runner_group_name :str | None = None
 	runner_id :int | None = None
 
-	@pydantic.field_validator("html_url", mode='before')
-	def validate_html_url(cls, value):
-		if not value.startswith('https://'):
-			raise ValueError(f"Invalid URL format: {value}")
-		if '..' in value:
-			raise ValueError(f"URL {value} must not contain double dots")
-		if '"' in value:
-			raise ValueError(f"URL {value} must not contain quotations")
-
-		return value
-
-	@pydantic.field_validator("name", "workflow_name", mode='before')
-	def validate_name(cls, value):
-		if set(value) - set(string.ascii_letters + string.digits + '-_./ ()'):
-			# Technically, there are other characters than those above
-			# that are valid for job names. But for our purposes these are the ones we should encouter.
-			raise ValueError(f"job name {value} is not a valid name")
-		if '..' in value:
-			raise ValueError(f"job name {value} is not a valid name")
-		if '"' in value:
-			raise ValueError(f"job name {value} is not a valid name")
-
-		return value
-
 class WorkflowJob(pydantic.BaseModel):
 	action :str
 	workflow_job :WorkflowJobInfo
 	repository :Repository
-	sender :UserInfo
\ No newline at end of file
+	sender :UserInfo
+
+# The events we act on, keyed by their X-GitHub-Event header.
+# Any other event (ping, workflow_job etc) is accepted without being parsed.
+EVENT_MODELS = {
+	'pull_request': SlimPullRequest,
+}
+
+def parse_event(event :str, body :bytes) -> pydantic.BaseModel|None:
+	"""
+	Validates the body against the model of the given event,
+	or returns None if it's not an event we act on.
+	"""
+	if (model := EVENT_MODELS.get(event)) is None:
+		return None
+
+	return model.model_validate_json(body)
@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import pathlib
+import threading
+import contextlib
+import collections
+import httpx
+
+"""
+A conditional request cache for GitHub GET endpoints.
+GitHub answers a matching If-None-Match / If-Modified-Since with
+304 Not Modified, which does not count against the rate limit:
+ * https://docs.github.com/en/rest/using-the-rest-api/best-practices-for-using-the-rest-api#use-conditional-requests-if-appropriate
+"""
+
+log = logging.getLogger()
+
+# Only the headers we read from cached responses are kept
+KEPT_HEADERS = ('Content-Type', 'Link', 'ETag', 'Last-Modified')
+# The on-disk entries are pruned every this many writes
+PRUNE_INTERVAL = 100
+
+class CacheEntry:
+	def __init__(self, etag :str|None, last_modified :str|None, headers :dict, content :bytes):
+		self.etag = etag
+		self.last_modified = last_modified
+		self.headers = headers
+		self.content = content
+
+class ResponseCache:
+	"""
+	Keeps the last 200 response per URL, together with its ETag and Last-Modified.
+	At most :code:`max_entries` are kept in memory (least recently used are evicted),
+	and if :code:`path` is given every entry is also written to disk so that the
+	cache survives restarts. On disk at most :code:`max_files` are kept, the least
+	recently used (by modification time, which reads bump) are deleted.
+
+	The on-disk layer is used from asyncio.to_thread(), so the in-memory part is behind a lock.
+	"""
+	def __init__(self, max_entries :int, path :pathlib.Path|None = None, max_files :int = 10000):
+		self.max_entries = max_entries
+		self.path = path
+		self.max_files = max_files
+		self.entries :collections.OrderedDict[str, CacheEntry] = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.writes = 0
+		self._lock = threading.Lock()
+
+		if self.path:
+			self.path.mkdir(parents=True, exist_ok=True)
+
+	def _file(self, url :str) -> pathlib.Path:
+		return self.path / f"{hashlib.sha256(url.encode()).hexdigest()}.json"
+
+	def get(self, url :str) -> CacheEntry|None:
+		with self._lock:
+			if (entry := self.entries.get(url)) is not None:
+				self.entries.move_to_end(url)
+				return entry
+
+		if self.path and (cache_file := self._file(url)).exists():
+			try:
+				data = json.loads(cache_file.read_text())
+				entry = CacheEntry(data['etag'], data['last_modified'], data['headers'], data['content'].encode())
+				# Recently used, as far as pruning is concerned
+				os.utime(cache_file)
+			except (ValueError, KeyError, OSError) as error:
+				log.warning(f"Ignoring unreadable response cache file {cache_file}: {error}")
+				return None
+
+			self._remember(url, entry)
+			return entry
+
+		return None
+
+	def _remember(self, url :str, entry :CacheEntry):
+		with self._lock:
+			self.entries[url] = entry
+			self.entries.move_to_end(url)
+
+			while len(self.entries) > self.max_entries:
+				self.entries.popitem(last=False)
+
+	def prune(self):
+		"""
+		Deletes the least recently used files until at most :code:`max_files` are left.
+		Other processes may share the directory and prune it at the same time.
+		"""
+		files = []
+		with os.scandir(self.path) as entries:
+			for entry in entries:
+				if entry.name.endswith('.json'):
+					with contextlib.suppress(FileNotFoundError):
+						files.append((entry.stat().st_mtime, entry.path))
+
+		if len(files) <= self.max_files:
+			return
+
+		files.sort()
+		for _, cache_file in files[:len(files) - self.max_files]:
+			with contextlib.suppress(FileNotFoundError):
+				os.unlink(cache_file)
+
+	def put(self, url :str, response :httpx.Response):
+		etag = response.headers.get('ETag')
+		last_modified = response.headers.get('Last-Modified')
+
+		if etag is None and last_modified is None:
+			return
+
+		headers = {name: response.headers[name] for name in KEPT_HEADERS if name in response.headers}
+		entry = CacheEntry(etag, last_modified, headers, response.content)
+		self._remember(url, entry)
+
+		if self.path:
+			try:
+				self._file(url).write_text(json.dumps({
+					"url": url,
+					"etag": etag,
+					"last_modified": last_modified,
+					"headers": headers,
+					"content": response.content.decode('utf-8'),
+					"stored_at": time.time(),
+				}))
+			except (UnicodeDecodeError, OSError) as error:
+				log.warning(f"Could not write response cache entry for {url}: {error}")
+				return
+
+			with self._lock:
+				self.writes += 1
+				prune = self.writes % PRUNE_INTERVAL == 0
+
+			if prune:
+				self.prune()
+
+	def conditional_headers(self, entry :CacheEntry|None) -> dict:
+		headers = {}
+
+		if entry is not None:
+			if entry.etag:
+				headers['If-None-Match'] = entry.etag
+			if entry.last_modified:
+				headers['If-Modified-Since'] = entry.last_modified
+
+		return headers
+
+	def resolve(self, url :str, entry :CacheEntry|None, response :httpx.Response) -> httpx.Response:
+		"""
+		Turns a 304 into the cached response, and remembers new 200 responses.
+		"""
+		if response.status_code == 304 and entry is not None:
+			with self._lock:
+				self.hits += 1
+			return httpx.Response(200, headers=entry.headers, content=entry.content, request=response.request)
+
+		with self._lock:
+			self.misses += 1
+		if response.status_code == 200:
+			self.put(url, response)
+
+		return response
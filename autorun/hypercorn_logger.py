@@ -2,9 +2,13 @@ import os
 import sys
 import json
 import logging
+import tomllib
+from logging.config import dictConfig, fileConfig
 from typing import Any, IO, Mapping, Optional, TYPE_CHECKING, Union
 from hypercorn.logging import AccessLogAtoms
 
+from .json_logging import queue_handler
+
 """
 This is the `python -m autorun` entrypoint.
 We'll use hypercorn to start the API.
@@ -20,8 +24,8 @@ def _create_logger(
 ) -> Optional[logging.Logger]:
 	"""
 	Carbon copy of python-libs/hypercorn/logging.py -> _create_logger()
-	With the slight modification to the logging.Formatter() to use a JSON
-	format instead (which is not perfect - as it can cause issues with quotations)
+	With the slight modification that the handler writes JSON lines,
+	and sits behind a queue so that logging never blocks the event loop.
 	"""
 	if isinstance(target, logging.Logger):
 		return target
@@ -29,16 +33,9 @@ def _create_logger(
 	if target:
 		logger = logging.getLogger(name)
 		logger.handlers = [
-			logging.StreamHandler(sys_default) if target == "-" else logging.FileHandler(target)  # type: ignore # noqa: E501
+			queue_handler(logging.StreamHandler(sys_default) if target == "-" else logging.FileHandler(target))  # type: ignore # noqa: E501
 		]
 		logger.propagate = propagate
-		formatter = logging.Formatter(json.dumps({
-			"human_time" : "%(asctime)s",
-			"logger_name": "%(process)d",
-			"level": "%(levelname)s",
-			"message": "%(message)s"
-		}))
-		logger.handlers[0].setFormatter(formatter)
 		if level is not None:
 			logger.setLevel(logging.getLevelName(level.upper()))
 		return logger
@@ -60,8 +57,9 @@ class Logger:
 			sys.stdout,
 			propagate=False,
 		)
+		# Not propagated, the root logger writes the same JSON lines which would log everything twice
 		self.error_logger = _create_logger(
-			"hypercorn.error", config.errorlog, config.loglevel, sys.stderr
+			"hypercorn.error", config.errorlog, config.loglevel, sys.stderr, propagate=False
 		)
 
 		if config.logconfig is not None:
@@ -86,7 +84,14 @@ class Logger:
 	) -> None:
 		if self.access_logger is not None:
 			self.access_logger.info(
-				self.access_log_format, self.atoms(request, response, request_time)
+				self.access_log_format,
+				self.atoms(request, response, request_time),
+				extra={
+					"method": request.get("method"),
+					"path": request.get("path"),
+					"status": response["status"] if response else None,
+					"duration": request_time,
+				},
 			)
 
 	async def critical(self, message: str, *args: Any, **kwargs: Any) -> None:
@@ -0,0 +1,119 @@
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import logging.handlers
+import threading
+import typing
+
+"""
+Structured JSON logging that never blocks the event loop.
+Records are serialized with json.dumps() instead of being templated
+into a JSON looking format string, so quotes in messages are safe.
+Anything passed as :code:`extra={...}` ends up as its own field:
+
+	log.info(f"Listed changed files", extra={"repository": "owner/repo", "pr": 1, "duration": 0.2})
+
+The handlers doing the actual I/O sit behind a QueueHandler, and are
+run by a QueueListener in its own thread. The record is serialized by the
+QueueHandler before it is queued, as that is where the exception info is still around.
+"""
+
+# Attributes every LogRecord has, anything else was passed in as extra={...}
+RECORD_ATTRIBUTES = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {'message', 'asctime', 'taskName'}
+
+# Started listeners, stopped (and flushed) on exit
+_listeners :typing.List[logging.handlers.QueueListener] = []
+
+class JsonFormatter(logging.Formatter):
+	def format(self, record :logging.LogRecord) -> str:
+		entry = {
+			"human_time": self.formatTime(record),
+			"logger_name": record.name,
+			"process": record.process,
+			"level": record.levelname,
+			"message": record.getMessage(),
+		}
+
+		for key, value in record.__dict__.items():
+			if key not in RECORD_ATTRIBUTES and not key.startswith('_'):
+				entry[key] = value
+
+		if record.exc_info:
+			entry["exception"] = self.formatException(record.exc_info)
+
+		return json.dumps(entry, default=str)
+
+class RateLimitFilter(logging.Filter):
+	"""
+	Lets through :code:`burst` records at once and then :code:`rate` records per second,
+	with a token bucket. The number of dropped records is added to the next record
+	that gets through, as the :code:`suppressed` field. A rate of 0 disables the limit.
+	"""
+	def __init__(self, rate :float, burst :int):
+		super().__init__()
+		self.rate = rate
+		self.burst = burst
+		self.tokens = float(burst)
+		self.updated = time.monotonic()
+		self.suppressed = 0
+		# Hypercorn logs access from every worker task
+		self.lock = threading.Lock()
+
+	def filter(self, record :logging.LogRecord) -> bool:
+		if self.rate <= 0:
+			return True
+
+		with self.lock:
+			now = time.monotonic()
+			self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+			self.updated = now
+
+			if self.tokens < 1:
+				self.suppressed += 1
+				return False
+
+			self.tokens -= 1
+			if self.suppressed:
+				record.suppressed = self.suppressed
+				self.suppressed = 0
+
+		return True
+
+def queue_handler(handler :logging.Handler) -> logging.handlers.QueueHandler:
+	"""
+	Puts the given handler behind a queue, the returned QueueHandler
+	only enqueues the record and the I/O is done by a listener thread.
+	"""
+	# The message is already JSON by the time it's dequeued
+	handler.setFormatter(logging.Formatter('%(message)s'))
+
+	records = queue.SimpleQueue()
+	listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+	listener.start()
+	_listeners.append(listener)
+
+	enqueue = logging.handlers.QueueHandler(records)
+	enqueue.setFormatter(JsonFormatter())
+
+	return enqueue
+
+def setup(level :str, stream :typing.IO = sys.stdout) -> logging.Logger:
+	"""
+	Replaces the handlers on the root logger with a queued JSON handler on :code:`stream`.
+	"""
+	log = logging.getLogger()
+	log.setLevel(level)
+
+	handler = queue_handler(logging.StreamHandler(stream))
+	handler.setLevel(level)
+	log.handlers = [handler]
+
+	return log
+
+@atexit.register
+def stop_listeners():
+	while _listeners:
+		_listeners.pop().stop()
@@ -0,0 +1,188 @@
+import re
+import bisect
+import hashlib
+import typing
+import itertools
+
+"""
+Matches changed files against the protected path rules.
+Instead of running every rule against every file in a nested Python loop,
+the rules are analysed once on config load. Most rules contain a literal
+(".github/", "tests/", "setup.py"), and a file can only match such a rule if
+it contains that literal. So the whole diff is joined into one string, and each
+literal is looked for with a single str.find() over it. Only the files that
+contain the literal are then checked with the actual rule. Rules without a
+required literal fall back to being searched file by file.
+
+A single alternation regex of all rules was measured to be slower than the
+nested loop, as the re module only does its fast literal prefix scan for
+patterns that start with a literal, not for alternations.
+"""
+
+# git paths can never contain NUL, which makes it a safe separator for the joined diff
+SEPARATOR = '\0'
+SPECIAL = set('.^$*+?{}[]()|\\')
+QUANTIFIERS = set('*+?{')
+BRACES = re.compile(r'\{\d*(,\d*)?\}')
+# Escapes that are longer than two characters (\x2e, \u002e, \U0000002e, \N{FULL STOP}, \056) or
+# refer back to a group (\1). Rules with these get no prefilter, rather than guessing at what they match.
+LONG_ESCAPES = set('xuUN0123456789')
+
+def _skip_class(pattern :str, index :int) -> int:
+	"""
+	Returns the index just after the character class starting at :code:`index`.
+	"""
+	index += 1
+	if index < len(pattern) and pattern[index] == '^':
+		index += 1
+	# A ] right at the start of a class is a literal
+	if index < len(pattern) and pattern[index] == ']':
+		index += 1
+
+	while index < len(pattern) and pattern[index] != ']':
+		index += 2 if pattern[index] == '\\' else 1
+
+	return index + 1
+
+def required_literal(rule :re.Pattern) -> str:
+	"""
+	Returns the longest literal text that every match of :code:`rule` contains,
+	or an empty string if there is none we can be sure of. Only the top level of
+	the pattern is looked at, groups and character classes are skipped over.
+	"""
+	pattern = rule.pattern
+
+	if isinstance(pattern, bytes) or rule.flags & (re.IGNORECASE | re.VERBOSE):
+		return ''
+
+	runs = [[]]
+	depth = 0
+	index = 0
+	while index < len(pattern):
+		char = pattern[index]
+
+		if char == '\\':
+			escaped = pattern[index + 1:index + 2]
+			index += 2
+			if escaped in LONG_ESCAPES:
+				return ''
+			# \d, \w, \b and friends are not literals, escaped punctuation is
+			if depth == 0 and escaped and not escaped.isalnum():
+				runs[-1].append(escaped)
+			elif depth == 0:
+				runs.append([])
+			continue
+
+		if char == '[':
+			index = _skip_class(pattern, index)
+			if depth == 0:
+				runs.append([])
+			continue
+
+		if char == '{' and (quantifier := BRACES.match(pattern, index)):
+			# {m,n} repeats the previous character, which is then optional or repeated
+			if depth == 0:
+				if runs[-1]:
+					runs[-1].pop()
+				runs.append([])
+			index = quantifier.end()
+			continue
+
+		if char == '(':
+			if depth == 0:
+				runs.append([])
+			depth += 1
+		elif char == ')':
+			depth -= 1
+			if depth == 0:
+				runs.append([])
+		elif depth == 0:
+			if char == '|':
+				# A top level alternation makes every literal optional
+				return ''
+			if char in QUANTIFIERS:
+				# The quantified character is optional or repeated
+				if runs[-1]:
+					runs[-1].pop()
+				runs.append([])
+			elif char in SPECIAL:
+				runs.append([])
+			else:
+				runs[-1].append(char)
+		index += 1
+
+	literal = max((''.join(run) for run in runs), key=len)
+
+	return '' if SEPARATOR in literal else literal
+
+class ProtectedMatcher:
+	def __init__(self, rules :typing.List[re.Pattern|str]):
+		# re.compile() returns already compiled patterns as-is
+		self.rules = [re.compile(rule) for rule in rules]
+		self.literals = [required_literal(rule) for rule in self.rules]
+		# Rules we can't prefilter, searched file by file
+		self.fallback = [(index, rule) for index, (rule, literal) in enumerate(zip(self.rules, self.literals)) if not literal]
+		# Identifies the rules (in order, with flags), decisions made with other rules don't apply
+		self.fingerprint = hashlib.sha256('\0'.join(f"{rule.flags}:{rule.pattern!r}" for rule in self.rules).encode()).hexdigest()
+
+	def __bool__(self) -> bool:
+		return bool(self.rules)
+
+	def match(self, filename :str) -> re.Pattern|None:
+		"""
+		Returns the first rule that matches the filename, if any.
+		"""
+		for rule, literal in zip(self.rules, self.literals):
+			if (not literal or literal in filename) and rule.search(filename) is not None:
+				return rule
+
+		return None
+
+	def first(self, filenames :typing.Sequence[str]) -> tuple[re.Pattern, str]|None:
+		"""
+		Returns the (rule, filename) of the first file that matches any rule, and the
+		first rule it matched, just like the nested loop would. None if no file is protected.
+		"""
+		if not filenames:
+			return None
+
+		joined = SEPARATOR.join(filenames)
+		offsets = None
+		# (file index, rule index) of the earliest match found so far
+		best = (len(filenames), len(self.rules))
+
+		for rule_index, (rule, literal) in enumerate(zip(self.rules, self.literals)):
+			if not literal:
+				continue
+
+			position = joined.find(literal)
+			while position != -1:
+				if offsets is None:
+					# Start offset of each file in the joined string
+					offsets = list(itertools.accumulate((len(filename) + 1 for filename in filenames), initial=0))
+
+				file_index = bisect.bisect_right(offsets, position) - 1
+				if (file_index, rule_index) >= best:
+					break
+
+				if rule.search(filenames[file_index]) is not None:
+					best = (file_index, rule_index)
+					break
+
+				# Continue with the next file, this one did not match the rule
+				position = joined.find(literal, offsets[file_index + 1])
+
+		if self.fallback:
+			for file_index, filename in enumerate(filenames[:best[0] + 1]):
+				for rule_index, rule in self.fallback:
+					if (file_index, rule_index) >= best:
+						break
+
+					if rule.search(filename) is not None:
+						best = (file_index, rule_index)
+						break
+
+		if best[0] < len(filenames):
+			return self.rules[best[1]], filenames[best[0]]
+
+		return None
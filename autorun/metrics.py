@@ -0,0 +1,128 @@
+import time
+import bisect
+import typing
+import contextlib
+
+"""
+A minimal set of Prometheus metrics, rendered in the text exposition format on /metrics:
+ * https://prometheus.io/docs/instrumenting/exposition_formats/#text-based-format
+
+Recording a value is a dict lookup and an addition, so instrumenting the
+hot path costs next to nothing. Label values are passed positionally,
+in the order of the label names of the metric.
+"""
+
+# Seconds, from a fast signature check up to a slow clone
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+# Events we expect to receive, anything else is counted as 'other' to keep the label set bounded
+KNOWN_EVENTS = {'ping', 'pull_request', 'workflow_job', 'workflow_run', 'check_run', 'check_suite', 'push'}
+
+REGISTRY :list['Metric'] = []
+
+def _escape(value :str) -> str:
+	return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _labels(names :tuple[str, ...], values :tuple, bucket :str|None = None) -> str:
+	pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+	if bucket is not None:
+		pairs.append(f'le="{bucket}"')
+
+	return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Metric:
+	kind = 'untyped'
+
+	def __init__(self, name :str, documentation :str, labels :typing.Sequence[str] = ()):
+		self.name = name
+		self.documentation = documentation
+		self.labels = tuple(labels)
+		self.values :dict[tuple, typing.Any] = {}
+		REGISTRY.append(self)
+
+	def samples(self) -> typing.Iterator[str]:
+		for labels, value in self.values.items():
+			yield f"{self.name}{_labels(self.labels, labels)} {value}"
+
+	def render(self) -> str:
+		return '\n'.join([f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}", *self.samples()])
+
+class Counter(Metric):
+	kind = 'counter'
+
+	def inc(self, *labels, amount :float = 1):
+		self.values[labels] = self.values.get(labels, 0) + amount
+
+class Gauge(Metric):
+	"""
+	A gauge is either set directly, or read from :code:`function()` when rendered.
+	A gauge with labels has the function return a dict of the values by their label values.
+	"""
+	kind = 'gauge'
+
+	def __init__(self, name :str, documentation :str, labels :typing.Sequence[str] = (), function :typing.Callable[[], float]|None = None):
+		super().__init__(name, documentation, labels)
+		self.function = function
+
+	def set(self, value :float, *labels):
+		self.values[labels] = value
+
+	def inc(self, *labels, amount :float = 1):
+		self.values[labels] = self.values.get(labels, 0) + amount
+
+	def dec(self, *labels, amount :float = 1):
+		self.inc(*labels, amount=-amount)
+
+	def samples(self) -> typing.Iterator[str]:
+		if self.function is not None:
+			value = self.function()
+			self.values = value if isinstance(value, dict) else {(): value}
+
+		yield from super().samples()
+
+class Histogram(Metric):
+	kind = 'histogram'
+
+	def __init__(self, name :str, documentation :str, labels :typing.Sequence[str] = (), buckets :typing.Sequence[float] = DEFAULT_BUCKETS):
+		super().__init__(name, documentation, labels)
+		self.buckets = tuple(sorted(buckets))
+
+	def observe(self, value :float, *labels):
+		# [per bucket counts (not cumulative), +Inf count, sum]
+		if (entry := self.values.get(labels)) is None:
+			entry = self.values[labels] = [[0] * len(self.buckets), 0, 0.0]
+
+		index = bisect.bisect_left(self.buckets, value)
+		if index < len(self.buckets):
+			entry[0][index] += 1
+		entry[1] += 1
+		entry[2] += value
+
+	@contextlib.contextmanager
+	def time(self, *labels):
+		started = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(time.perf_counter() - started, *labels)
+
+	def samples(self) -> typing.Iterator[str]:
+		for labels, (counts, count, total) in self.values.items():
+			cumulative = 0
+			for bound, bucket in zip(self.buckets, counts):
+				cumulative += bucket
+				yield f"{self.name}_bucket{_labels(self.labels, labels, str(bound))} {cumulative}"
+			yield f"{self.name}_bucket{_labels(self.labels, labels, '+Inf')} {count}"
+			yield f"{self.name}_sum{_labels(self.labels, labels)} {total}"
+			yield f"{self.name}_count{_labels(self.labels, labels)} {count}"
+
+def render() -> str:
+	return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+webhook_requests = Counter('autorun_webhook_requests_total', 'Webhook deliveries by event, action and outcome.', ('event', 'action', 'outcome'))
+stage_seconds = Histogram('autorun_stage_seconds', 'Time spent in each stage of handling a delivery.', ('stage',))
+github_api_requests = Counter('autorun_github_api_requests_total', 'GitHub API calls by method and status code.', ('method', 'status'))
+git_fetch_bytes = Histogram('autorun_git_fetch_bytes', 'Pack bytes received per git fetch, by strategy.', ('strategy',), buckets=[4 ** exponent * 1024 for exponent in range(11)])
+changed_files_seconds = Histogram('autorun_changed_files_seconds', 'Time spent listing the changed files of a PR, by strategy.', ('strategy',))
+decision_cache = Counter('autorun_decision_cache_total', 'Decision cache lookups by result.', ('result',))
+verifications = Counter('autorun_verifications_total', 'Finished PR verifications by result.', ('result',))
@@ -0,0 +1,327 @@
+import asyncio
+import logging
+import contextlib
+import functools
+import typing
+import httpx
+
+from .config import config
+from . import github_api
+from . import metrics
+from .access import AccessCheck
+from .shared_state import SharedState, supersedes
+from .decision_cache import Decision, DecisionCache
+from .github_models import SlimPullRequest, WorkflowRun, WorkflowRuns
+from .git_cache import MirrorCache
+from .changed_files import ChangedFilesProvider, GitProvider, GithubApiProvider
+from .strategy import BACKENDS, Strategy, plan, timed
+
+"""
+The verification pipeline for a single pull request event:
+list the changed files, check them against the protected paths
+and then either approve or cancel the workflow runs of the PR.
+"""
+
+log = logging.getLogger()
+
+git_cache = MirrorCache(config.cache.path, config.cache.max_size, config.cache.gc_interval)
+access_check = AccessCheck()
+shared_state = SharedState(config.workers.state_path or config.cache.path / 'state.sqlite3', config.workers.claim_lease)
+decision_cache = DecisionCache(config.cache.decisions_path or config.cache.path / 'decisions.sqlite3', config.cache.decision_ttl, config.cache.decision_entries)
+
+# The maximum page size of /actions/runs
+RUNS_PAGE_SIZE = 100
+
+# Used in the log line once a run has been approved or cancelled
+ACTION_DONE = {
+	'approve': 'Started',
+	'cancel': 'Canceled',
+}
+# The verifications metric result of each action
+ACTION_RESULT = {
+	'approve': 'approved',
+	'cancel': 'cancelled',
+}
+
+def coalesce_key(payload :SlimPullRequest) -> tuple[tuple[str, int], str]:
+	"""
+	Pull request events are coalesced per PR, only the latest head sha is worth verifying.
+	"""
+	return (payload.pull_request.base.repo.full_name, payload.pull_request.number), payload.pull_request.head.sha
+
+def push_order(payload :SlimPullRequest) -> tuple[str, float|None, str|None]:
+	"""
+	The head sha, when it was pushed and what it was pushed on top of, as far as the event tells.
+	"""
+	updated_at = payload.pull_request.updated_at
+
+	return payload.pull_request.head.sha, updated_at.timestamp() if updated_at else None, payload.before
+
+def is_newer(payload :SlimPullRequest, latest :SlimPullRequest) -> bool:
+	"""
+	Whether the event is about the same or a newer push than :code:`latest`,
+	a late retry or a redelivery of an older push is not.
+	"""
+	return supersedes(*push_order(payload), *push_order(latest))
+
+def state_key(payload :SlimPullRequest) -> str:
+	"""
+	The key of the PR in the state shared between processes.
+	"""
+	return f"{payload.pull_request.base.repo.full_name}#{payload.pull_request.number}"
+
+async def is_latest(payload :SlimPullRequest) -> bool:
+	"""
+	Whether no process has received a newer push to the PR since this one.
+	"""
+	return await asyncio.to_thread(shared_state.is_latest, state_key(payload), payload.pull_request.head.sha)
+
+def repository_group(payload :SlimPullRequest) -> str:
+	"""
+	Each repository gets a work queue of its own.
+	"""
+	return payload.pull_request.base.repo.full_name
+
+def repository_limit(full_name :str) -> int|None:
+	"""
+	How many PR's of the repository may be verified at once, None for no limit.
+	"""
+	if (repository := config.repository(full_name)) is None:
+		return None
+
+	return repository.concurrency
+
+def log_fields(payload :SlimPullRequest, stage :str, **fields) -> dict:
+	"""
+	The structured fields of our log lines about a PR, passed as :code:`extra=`.
+	"""
+	return {
+		"repository": payload.pull_request.base.repo.full_name,
+		"pr": payload.pull_request.number,
+		"stage": stage,
+		**fields,
+	}
+
+async def retried(call :typing.Callable[[], typing.Awaitable], what :str, fields :dict):
+	"""
+	Returns what :code:`call()` returns, calling it again on transient GitHub API errors
+	(with exponential backoff), [github] api_retries times in all.
+	"""
+	for attempt in range(1, config.github.api_retries + 1):
+		try:
+			return await call()
+		except httpx.HTTPError as error:
+			if attempt < config.github.api_retries and github_api.is_transient(error):
+				log.warning(f"Could not {what} (attempt {attempt}): {error}", extra=fields)
+				await asyncio.sleep(config.github.api_retry_backoff * 2 ** (attempt - 1))
+				continue
+
+			raise
+
+async def list_pr_jobs(headers, payload) -> typing.AsyncIterator[WorkflowRun]:
+	"""
+	Lists all runners associated with the PR head sha sum, page by page.
+	Runs are yielded as soon as their page has been parsed, and
+	transient failures are retried per page.
+	"""
+	url = (
+		f'{github_api.API_URL}/repos/{payload.pull_request.base.repo.full_name}/actions/runs?'
+		+ f'event=pull_request'
+		#+ f'&status=action_required'
+		+ f'&head_sha={payload.pull_request.head.sha}'
+		+ f'&per_page={RUNS_PAGE_SIZE}'
+	)
+
+	async def get_page(url :str):
+		with metrics.stage_seconds.time('list_runs'):
+			return await github_api.get(url, headers)
+
+	while url:
+		response = await retried(functools.partial(get_page, url), f"list the runs of PR #{payload.pull_request.number}", log_fields(payload, 'list_runs'))
+		url = github_api.next_link(response.headers.get('Link'))
+
+		if not response.headers.get('Content-Type', '').startswith('application/json'):
+			return
+
+		# Iterate any job related to the PR
+		for job in WorkflowRuns.model_validate_json(response.content).workflow_runs:
+			if job.head_sha != payload.pull_request.head.sha:
+				log.warning(f"Job {job.head_sha} does not match pull requests {payload.pull_request.head.sha}")
+
+				# Something's fishy, and we're out of chips!
+				return
+
+			log.debug(f"Found job '{job.name}' related to Pull Requests {', '.join(['#'+str(pr.number) for pr in job.pull_requests])} called '{job.display_title}'")
+			yield job
+
+async def run_action(action :str, headers, payload) -> tuple[int, dict[int, Exception]]:
+	"""
+	POSTs :code:`action` (approve or cancel) to every incomplete run of the PR.
+	The calls go out concurrently, at most [github] api_parallelism at a time,
+	and transient failures are retried per run. Returns how many runs there were,
+	and the errors per run id. If listing the runs fails, the runs already listed
+	are still posted before the error is raised.
+	"""
+	semaphore = asyncio.Semaphore(config.github.api_parallelism)
+	errors = {}
+
+	async def post(job):
+		async def request():
+			with metrics.stage_seconds.time(action):
+				await github_api.request(
+					"POST",
+					f'{github_api.API_URL}/repos/{payload.pull_request.base.repo.full_name}/actions/runs/{job.id}/{action}',
+					headers
+				)
+
+		async with semaphore:
+			try:
+				await retried(request, f"{action} job '{job.name}'", log_fields(payload, action, run=job.id))
+			except httpx.HTTPError as error:
+				log.error(f"Failed to {action} job '{job.name}': {error}", extra=log_fields(payload, action, run=job.id))
+				errors[job.id] = error
+			else:
+				log.info(f"{ACTION_DONE[action]} job '{job.name}'", extra=log_fields(payload, action, run=job.id))
+
+	jobs = 0
+	listing_error = None
+	# Jobs are posted as soon as they are listed
+	async with asyncio.TaskGroup() as group:
+		try:
+			async for job in list_pr_jobs(headers, payload):
+				if job.status != 'completed':
+					group.create_task(post(job))
+					jobs += 1
+		except Exception as error:
+			# Raised once the runs already listed are done, instead of abandoning them half way
+			listing_error = error
+
+	if errors:
+		log.error(f"Could not {action} {len(errors)} of {jobs} jobs in PR #{payload.pull_request.number}", extra=log_fields(payload, action))
+
+	if listing_error is not None:
+		log.error(f"Could not list all runs of PR #{payload.pull_request.number} to {action}, {jobs - len(errors)} were done: {listing_error}", extra=log_fields(payload, action))
+		raise listing_error
+
+	return jobs, errors
+
+def action_result(action :str, jobs :int, errors :dict) -> str:
+	"""
+	The result of a verification for the verifications metric, telling apart
+	the ones where some (or all) of the runs could not be approved or cancelled.
+	"""
+	done = ACTION_RESULT[action]
+	if not errors:
+		return done
+	if len(errors) < jobs:
+		return f"partially_{done}"
+
+	return f"{action}_failed"
+
+async def handle_pull_request(payload :SlimPullRequest) -> bool|None:
+	"""
+	Runs verify_pull_request(), unless this revision of the PR is already being verified
+	(by another process, or for a redelivery) or a newer push to the PR has come in.
+	"""
+	key = state_key(payload)
+
+	if (token := await asyncio.to_thread(shared_state.claim, key, payload.pull_request.head.sha)) is None:
+		log.info(f"Not verifying PR #{payload.pull_request.number} at {payload.pull_request.head.sha}, it is outdated or already being verified", extra=log_fields(payload, 'claim'))
+		return None
+
+	try:
+		return await verify_pull_request(payload)
+	finally:
+		await asyncio.to_thread(shared_state.release, key, token)
+
+async def verify_pull_request(payload :SlimPullRequest) -> bool|None:
+	"""
+	Returns True if the runners of the PR were approved,
+	and False if they were cancelled due to a protected path being modified.
+	None if a newer push to the PR came in while we were verifying it.
+	"""
+	# The webhook only queues PR's of repositories we serve
+	repository = config.repository(payload.pull_request.base.repo.full_name)
+
+	if await access_check.wait(payload.pull_request.base.repo.full_name) is False:
+		log.error(f"Not verifying PR #{payload.pull_request.number}, we have no access to {payload.pull_request.base.repo.full_name}", extra=log_fields(payload, 'access'))
+		return False
+
+	# Used to call the GitHub API during queries
+	headers = {
+		"Accept": "application/vnd.github+json",
+		"Authorization": github_api.authorization(repository.access_token),
+		"X-GitHub-Api-Version": "2022-11-28"
+	}
+
+	# payload.head < PR reference
+	# payload.base < Target reference
+
+	# .. todo::
+	#    Perhaps we can optimize here, and check if the payload.sender is an outside collaborator
+	#    and only perform our checks if that is the case. As there is no way to force all runners to be approved.
+	#    Only outside collaborators - unless Workaround 3 is chosen: https://md.archlinux.org/s/aIL4kaCtY#workaround-3
+
+	log.info(f"Verifying that the PR #{payload.pull_request.number} '{payload.pull_request.title}' does not modify any proected paths defined in the config.", extra=log_fields(payload, 'verify'))
+
+	# Pick the cheapest way to list the files changed by the PR
+	strategy = plan(payload, git_cache.is_complete(payload.pull_request.base.repo.full_name), BACKENDS[config.github.diff_backend])
+	provider :ChangedFilesProvider
+	if strategy == Strategy.API:
+		provider = GithubApiProvider(headers)
+	else:
+		provider = GitProvider(git_cache, shallow=strategy == Strategy.SHALLOW)
+
+	# Check if any file lives in .github/workflows
+	if repository.matcher:
+		# The same base, head, comparison and rules always give the same verdict (reopened PR's, redeliveries and re-runs)
+		decision_key = (payload.pull_request.base.repo.full_name, payload.pull_request.base.sha, payload.pull_request.head.sha, provider.comparison, repository.matcher.fingerprint)
+
+		match = None
+		if (decision := await asyncio.to_thread(decision_cache.get, *decision_key)) is not None:
+			metrics.decision_cache.inc('hit')
+			log.info(f"Reusing the verdict for {payload.pull_request.base.sha[:7]}..{payload.pull_request.head.sha[:7]}", extra=log_fields(payload, 'changed_files'))
+			if decision.protected:
+				match = (decision.rule, decision.path)
+		else:
+			metrics.decision_cache.inc('miss')
+			with timed(strategy, payload.pull_request.number, log_fields(payload, 'changed_files')):
+				async with contextlib.aclosing(provider.changed_files(payload)) as file_changes:
+					async for filenames in file_changes:
+						with metrics.stage_seconds.time('match'):
+							if (first := repository.matcher.first(filenames)) is not None:
+								match = (first[0].pattern, first[1])
+
+						if match is not None:
+							break
+
+			await asyncio.to_thread(decision_cache.put, *decision_key, Decision(match[1], match[0]) if match else Decision(None, None))
+
+		# Another process may have received a newer push while we were diffing
+		if not await is_latest(payload):
+			log.info(f"PR #{payload.pull_request.number} was pushed to while verifying {payload.pull_request.head.sha}, leaving it to the newer push", extra=log_fields(payload, 'match'))
+			return None
+
+		if match:
+			rule, filename = match
+			log.warning(f"Cancelling runners in PR from executing, as they have modified proected file: {filename} (matched {rule})", extra=log_fields(payload, 'match', path=filename, rule=rule))
+
+			jobs, errors = await run_action('cancel', headers, payload)
+			metrics.verifications.inc(action_result('cancel', jobs, errors))
+
+			# Deleting jobs, will allow PR's to be merged as there will be
+			# no incomplete jobs blocking the merger. If that's what we want,
+			# do a DELETE on /actions/runs/{job.id} for each job as well.
+
+			return False
+
+		log.info(f"PR did not modify any configured protected paths", extra=log_fields(payload, 'match'))
+	else:
+		log.warning(f"No paths are defined as proected in the configuration.")
+
+	# All should be good here,
+	# lets approve the individual runners (I don't think there's a batch approval?)
+	jobs, errors = await run_action('approve', headers, payload)
+	metrics.verifications.inc(action_result('approve', jobs, errors))
+
+	return True
@@ -0,0 +1,129 @@
+import time
+import enum
+import asyncio
+import logging
+import httpx
+
+"""
+Keeps track of the GitHub REST API rate limit budget, as reported by
+the X-RateLimit-* headers of every response, and schedules calls so that
+approving and cancelling runners keeps working when the budget gets tight:
+ * https://docs.github.com/en/rest/using-the-rest-api/rate-limits-for-the-rest-api
+"""
+
+log = logging.getLogger()
+
+class Priority(enum.IntEnum):
+	HIGH = 0 # Approving and cancelling runs
+	LOW = 1 # Listing runs and files
+
+def is_rate_limited(response :httpx.Response) -> bool:
+	"""
+	Whether GitHub turned the call down for going over a rate limit (429, or a 403
+	primary/secondary rate limit), rather than for lacking permission.
+	"""
+	if response.status_code not in (403, 429):
+		return False
+
+	if response.status_code == 403 and response.headers.get('X-RateLimit-Remaining') != '0' and 'Retry-After' not in response.headers:
+		# Secondary rate limits don't always come with headers, but do say so in the message
+		return 'rate limit' in response.text.lower()
+
+	return True
+
+class RateLimitScheduler:
+	"""
+	Once fewer than :code:`reserve` calls remain in the current window, only
+	high priority calls are let through until the window resets.
+	When GitHub tells us to back off (429, or a 403 primary/secondary rate limit)
+	every call waits, for Retry-After seconds if given or with an exponential
+	backoff capped at :code:`max_backoff` seconds.
+	"""
+	def __init__(self, reserve :int, max_backoff :float):
+		self.reserve = reserve
+		self.max_backoff = max_backoff
+		self.limit :int|None = None
+		self.remaining :int|None = None
+		self.used :int|None = None
+		self.reset_at :float|None = None
+		self.blocked_until = 0.0
+		self.throttled = 0
+		self.waiting = {priority: 0 for priority in Priority}
+
+	def tight(self) -> bool:
+		return self.remaining is not None and self.remaining <= self.reserve and (self.reset_at or 0) > time.time()
+
+	async def acquire(self, priority :Priority):
+		"""
+		Waits until a call of the given priority is allowed to go out.
+		"""
+		self.waiting[priority] += 1
+		try:
+			while True:
+				now = time.time()
+
+				if self.blocked_until > now:
+					await asyncio.sleep(self.blocked_until - now)
+					continue
+
+				if priority != Priority.HIGH and self.tight():
+					log.debug(f"Rate limit budget is low ({self.remaining} left), holding back a low priority call")
+					await asyncio.sleep(min(self.reset_at - now, self.max_backoff))
+					continue
+
+				return
+		finally:
+			self.waiting[priority] -= 1
+
+	def update(self, response :httpx.Response):
+		headers = response.headers
+
+		try:
+			if 'X-RateLimit-Remaining' in headers:
+				self.remaining = int(headers['X-RateLimit-Remaining'])
+			if 'X-RateLimit-Limit' in headers:
+				self.limit = int(headers['X-RateLimit-Limit'])
+			if 'X-RateLimit-Used' in headers:
+				self.used = int(headers['X-RateLimit-Used'])
+			if 'X-RateLimit-Reset' in headers:
+				self.reset_at = float(headers['X-RateLimit-Reset'])
+		except ValueError:
+			log.warning(f"Could not parse rate limit headers from {response.url}")
+
+	def backoff(self, response :httpx.Response, attempt :int) -> float|None:
+		"""
+		Returns how many seconds to back off for if the response was rate limited,
+		and blocks all other calls for that long as well. None if it was not rate limited.
+		"""
+		if not is_rate_limited(response):
+			return None
+
+		if (retry_after := response.headers.get('Retry-After', '')).isdigit():
+			delay = float(retry_after)
+		elif response.headers.get('X-RateLimit-Remaining') == '0' and self.reset_at:
+			delay = self.reset_at - time.time()
+		else:
+			# Wait at least a minute, as GitHub recommends for secondary rate limits
+			delay = 60.0 * 2 ** attempt
+
+		delay = max(1.0, min(delay, self.max_backoff))
+		self.blocked_until = max(self.blocked_until, time.time() + delay)
+		self.throttled += 1
+		log.warning(f"Rate limited by GitHub on {response.url}, backing off for {delay:.0f}s")
+
+		return delay
+
+	def budget(self) -> dict:
+		return {
+			"limit": self.limit,
+			"remaining": self.remaining,
+			"used": self.used,
+			"reset_at": self.reset_at,
+			"used_ratio": 1 - self.remaining / self.limit if self.limit and self.remaining is not None else None,
+			"reserve": self.reserve,
+			"tight": self.tight(),
+			"throttled": self.throttled,
+			"blocked_for": max(0.0, self.blocked_until - time.time()),
+			"waiting_high": self.waiting[Priority.HIGH],
+			"waiting_low": self.waiting[Priority.LOW],
+		}
@@ -0,0 +1,182 @@
+import os
+import time
+import uuid
+import logging
+import pathlib
+import sqlite3
+import threading
+import typing
+
+"""
+State shared between the hypercorn worker processes on this machine,
+kept in a SQLite database (in WAL mode, so readers don't block the writer).
+Each process has its own work queue, so without this two processes could
+both verify the same PR and approve its runs twice, or approve an older
+head after a newer push was handled by the other process.
+
+ * heads: the latest head sha seen per PR, by any process. "Latest" as in
+   pushed last, not received last: GitHub retries and manual redeliveries
+   of an older push never take a PR back to an older head (see supersedes())
+ * claims: which process is verifying which PR right now, with a lease
+   so that a crashed process doesn't block the PR forever
+
+The calls are quick, but can wait on another process holding the write lock,
+so they are run in a thread (asyncio.to_thread) to keep the event loop free.
+"""
+
+log = logging.getLogger()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS heads (key TEXT PRIMARY KEY, revision TEXT NOT NULL, pushed REAL, before TEXT, updated REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS claims (key TEXT PRIMARY KEY, revision TEXT NOT NULL, owner TEXT NOT NULL, expires REAL NOT NULL);
+"""
+
+# Delete expired rows every this many writes
+PRUNE_INTERVAL = 1000
+# PR's that haven't been pushed to in a week are forgotten
+RETENTION = 7 * 24 * 3600
+
+def supersedes(revision :str, pushed :float|None, before :str|None, current :str, current_pushed :float|None, current_before :str|None) -> bool:
+	"""
+	Whether :code:`revision` (pushed at :code:`pushed`, on top of :code:`before`)
+	is at least as new as the :code:`current` one. A push on top of the other one
+	settles it, otherwise the push times do. If we can't tell, the newest arrival wins.
+	"""
+	if revision == current:
+		return True
+	# Checked first, a force-push back to an earlier head is pushed on top of the current one too
+	if before == current:
+		return True
+	if current_before == revision:
+		return False
+	if pushed is not None and current_pushed is not None:
+		return pushed >= current_pushed
+
+	return True
+
+class SqliteStore:
+	"""
+	A SQLite database with :code:`schema`, used by one connection per process.
+	Subclasses delete their expired rows in :code:`prune()`, which is called
+	every :code:`PRUNE_INTERVAL` writes.
+	"""
+	schema = ""
+
+	def __init__(self, path :pathlib.Path):
+		self.path = path
+		self.writes = 0
+		self._connection :sqlite3.Connection|None = None
+		# There's one connection per process, used from the to_thread() pool one call at a time
+		self._lock = threading.Lock()
+
+	@property
+	def connection(self) -> sqlite3.Connection:
+		if self._connection is None:
+			self.path.parent.mkdir(parents=True, exist_ok=True)
+			# Autocommit, transactions are started explicitly where they're needed
+			self._connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+			self._connection.execute("PRAGMA journal_mode=WAL")
+			self._connection.execute("PRAGMA synchronous=NORMAL")
+			self._connection.executescript(self.schema)
+
+		return self._connection
+
+	def close(self):
+		with self._lock:
+			if self._connection is not None:
+				self._connection.close()
+				self._connection = None
+
+	def _read(self, query :str, parameters :tuple) -> tuple|None:
+		with self._lock:
+			return self.connection.execute(query, parameters).fetchone()
+
+	def _write(self, statements :typing.Callable[[sqlite3.Connection], typing.Any]):
+		"""
+		Runs :code:`statements` in a write transaction, and prunes old rows now and then.
+		"""
+		with self._lock:
+			connection = self.connection
+			connection.execute("BEGIN IMMEDIATE")
+			try:
+				result = statements(connection)
+
+				self.writes += 1
+				if self.writes % PRUNE_INTERVAL == 0:
+					self.prune(connection)
+			except BaseException:
+				connection.execute("ROLLBACK")
+				raise
+
+			connection.execute("COMMIT")
+			return result
+
+	def prune(self, connection :sqlite3.Connection):
+		pass
+
+class SharedState(SqliteStore):
+	"""
+	:code:`lease` is how many seconds a claim holds before another process may take over the PR.
+	"""
+	schema = SCHEMA
+
+	def __init__(self, path :pathlib.Path, lease :float):
+		super().__init__(path)
+		self.lease = lease
+
+	def prune(self, connection :sqlite3.Connection):
+		now = time.time()
+		connection.execute("DELETE FROM heads WHERE updated < ?", (now - RETENTION,))
+		connection.execute("DELETE FROM claims WHERE expires < ?", (now,))
+
+	def set_latest(self, key :str, revision :str, pushed :float|None = None, before :str|None = None) -> bool:
+		"""
+		Records :code:`revision` as the latest head of the PR, unless a newer one is already
+		recorded. Returns whether it was (or already is) the latest.
+		"""
+		def statements(connection :sqlite3.Connection) -> bool:
+			current = connection.execute("SELECT revision, pushed, before FROM heads WHERE key = ?", (key,)).fetchone()
+			if current is not None and not supersedes(revision, pushed, before, *current):
+				return False
+
+			connection.execute(
+				"INSERT INTO heads (key, revision, pushed, before, updated) VALUES (?, ?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET revision = excluded.revision, pushed = excluded.pushed, before = excluded.before, updated = excluded.updated",
+				(key, revision, pushed, before, time.time())
+			)
+			return True
+
+		return self._write(statements)
+
+	def is_latest(self, key :str, revision :str) -> bool:
+		row = self._read("SELECT revision FROM heads WHERE key = ?", (key,))
+
+		return row is None or row[0] == revision
+
+	def claim(self, key :str, revision :str) -> str|None:
+		"""
+		Claims the verification of :code:`revision` of the PR. Returns a token to
+		release the claim with, or None if the revision is outdated or someone else
+		(another process, or a redelivery in this one) is already verifying it.
+		"""
+		def statements(connection :sqlite3.Connection) -> str|None:
+			now = time.time()
+
+			latest = connection.execute("SELECT revision FROM heads WHERE key = ?", (key,)).fetchone()
+			if latest is not None and latest[0] != revision:
+				return None
+
+			claimed = connection.execute("SELECT revision, expires FROM claims WHERE key = ?", (key,)).fetchone()
+			if claimed is not None and claimed[0] == revision and claimed[1] > now:
+				return None
+
+			token = f"{os.getpid()}:{uuid.uuid4().hex}"
+			connection.execute(
+				"INSERT INTO claims (key, revision, owner, expires) VALUES (?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET revision = excluded.revision, owner = excluded.owner, expires = excluded.expires",
+				(key, revision, token, now + self.lease)
+			)
+			return token
+
+		return self._write(statements)
+
+	def release(self, key :str, token :str):
+		self._write(lambda connection: connection.execute("DELETE FROM claims WHERE key = ? AND owner = ?", (key, token)))
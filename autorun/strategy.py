@@ -0,0 +1,96 @@
+import enum
+import math
+import time
+import logging
+import contextlib
+
+from . import metrics
+from .changed_files import API_FILE_LIMIT, API_PAGE_SIZE
+
+"""
+Picks the cheapest way of listing the changed files of a pull request.
+The PR payload tells us how many files, lines and commits are involved,
+and the repository payload how big the repository is (in KiB).
+The costs below are rough estimates in KiB transferred, they
+only need to be good enough to rank the strategies against each other.
+"""
+
+log = logging.getLogger()
+
+# Each API page is a round trip, and the compare endpoint includes the patch of each file.
+API_PAGE_COST = 50
+API_LINE_COST = 0.05
+# A blobless depth=1 fetch transfers two commits and their trees,
+# which is a small fraction of the packed repository size.
+SHALLOW_BASE_COST = 100
+SHALLOW_SIZE_FACTOR = 0.1
+# Fetching into a mirror that already has the full history only
+# transfers the new commits, roughly proportional to the commit count.
+FULL_INCREMENTAL_COMMIT_COST = 20
+
+class Strategy(enum.Enum):
+	API = 'api'
+	SHALLOW = 'shallow'
+	FULL = 'full'
+
+# The [github] diff_backend setting, mapped to the strategies it allows
+BACKENDS = {
+	'auto': None,
+	'api': {Strategy.API},
+	'git': {Strategy.SHALLOW, Strategy.FULL},
+	'shallow': {Strategy.SHALLOW},
+	'full': {Strategy.FULL},
+}
+
+@contextlib.contextmanager
+def timed(strategy :Strategy, number :int, fields :dict|None = None):
+	"""
+	Times listing the changed files with :code:`strategy`, into the log and the
+	autorun_changed_files_seconds histogram (whose count is how often each strategy ran).
+	"""
+	started = time.monotonic()
+	try:
+		yield
+	finally:
+		duration = time.monotonic() - started
+		metrics.changed_files_seconds.observe(duration, strategy.value)
+		log.info(f"Listed changed files of PR #{number} using the {strategy.value} strategy in {duration:.2f}s", extra={**(fields or {}), "strategy": strategy.value, "duration": duration})
+
+def estimate(payload, mirror_complete :bool) -> dict[Strategy, float]:
+	"""
+	Returns the estimated cost of each viable strategy for the given PR.
+	"""
+	pr = payload.pull_request
+	# The size is optional in the payload, without it the repository is treated as big so that we don't clone it by accident
+	size = pr.base.repo.size
+	costs = {}
+
+	if pr.changed_files <= API_FILE_LIMIT:
+		pages = max(1, math.ceil(pr.changed_files / API_PAGE_SIZE))
+		costs[Strategy.API] = pages * API_PAGE_COST + (pr.additions + pr.deletions) * API_LINE_COST
+
+	if size is not None:
+		costs[Strategy.SHALLOW] = SHALLOW_BASE_COST + size * SHALLOW_SIZE_FACTOR
+		costs[Strategy.FULL] = pr.commits * FULL_INCREMENTAL_COMMIT_COST if mirror_complete else size
+	else:
+		costs[Strategy.SHALLOW] = SHALLOW_BASE_COST
+
+	return costs
+
+def plan(payload, mirror_complete :bool, allowed :set[Strategy]|None = None) -> Strategy:
+	"""
+	Picks the cheapest of the :code:`allowed` strategies.
+	If none of the allowed strategies are viable, the cheapest viable one is used.
+	"""
+	costs = estimate(payload, mirror_complete)
+
+	if allowed and (candidates := {strategy: cost for strategy, cost in costs.items() if strategy in allowed}):
+		costs = candidates
+
+	strategy = min(costs, key=costs.get)
+	if strategy == Strategy.SHALLOW and mirror_complete:
+		# A complete mirror is never made shallow, the fetch into it is the incremental one
+		strategy = Strategy.FULL
+	log.debug(f"Estimated costs for PR #{payload.pull_request.number}: {', '.join(f'{s.value}={c:.0f}' for s, c in costs.items())}, picked {strategy.value}")
+
+	return strategy
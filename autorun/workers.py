@@ -0,0 +1,237 @@
+import time
+import asyncio
+import logging
+import collections
+import typing
+
+"""
+A bounded pool of background workers that run the verification pipeline.
+The webhook only enqueues work and answers right away, so that GitHub's
+10 second delivery timeout is never hit by a slow clone or diff.
+
+Work is queued per group (the repository), and the workers take turns
+between the groups, so one very busy repository can't starve the others.
+"""
+
+log = logging.getLogger()
+
+class WorkItem:
+	def __init__(self, payload, key :typing.Hashable, revision :str, group :typing.Hashable):
+		self.payload = payload
+		self.key = key
+		self.revision = revision
+		self.group = group
+		self.enqueued_at = time.monotonic()
+
+class WorkQueue:
+	"""
+	Runs :code:`handler(payload)` for each submitted payload on at most
+	:code:`workers` concurrent workers. At most :code:`max_size` items can
+	be waiting per group, after which :code:`submit()` refuses new work for it.
+
+	:code:`coalesce(payload)` returns a key and a revision for the payload.
+	Only the latest revision of a key is worth running, so older queued items
+	are skipped and older running items are cancelled. Which one is the latest is
+	up to :code:`supersedes(payload, latest_payload)`, by default the last one submitted.
+
+	:code:`group(payload)` returns which queue the payload goes in, the groups
+	are served round-robin and at most :code:`limit(group)` items of a group run at once.
+	"""
+	def __init__(
+		self,
+		handler :typing.Callable[[typing.Any], typing.Awaitable],
+		workers :int,
+		max_size :int,
+		coalesce :typing.Callable[[typing.Any], tuple[typing.Hashable, str]],
+		group :typing.Callable[[typing.Any], typing.Hashable] = lambda payload: None,
+		limit :typing.Callable[[typing.Hashable], int|None] = lambda group: None,
+		supersedes :typing.Callable[[typing.Any, typing.Any], bool] = lambda payload, latest: True,
+	):
+		self.handler = handler
+		self.coalesce = coalesce
+		self.supersedes = supersedes
+		self.group = group
+		self.limit = limit
+		self.workers = workers
+		self.max_size = max_size
+		self.busy = 0
+		self.started = 0
+		self.processed = 0
+		self.failed = 0
+		self.superseded = 0
+		self.wait_last = 0.0
+		self.wait_max = 0.0
+		self.wait_total = 0.0
+		self._tasks :list[asyncio.Task] = []
+		# Per group: the queued items, how many are running, and
+		# the round-robin order of the groups that have queued items.
+		self._queues :dict[typing.Hashable, collections.deque[WorkItem]] = {}
+		self._active :dict[typing.Hashable, int] = {}
+		self._order :collections.deque[typing.Hashable] = collections.deque()
+		# Set whenever a worker might be able to pick up something new
+		self._changed = asyncio.Event()
+		# Per key: the latest revision (item), how many items are queued
+		# and the revision + task currently being processed.
+		self._latest :dict[typing.Hashable, WorkItem] = {}
+		self._pending :dict[typing.Hashable, int] = {}
+		self._running :dict[typing.Hashable, tuple[str, asyncio.Task]] = {}
+
+	def depth(self) -> int:
+		return sum(len(queue) for queue in self._queues.values())
+
+	def group_depth(self, group :typing.Hashable) -> int:
+		return len(self._queues.get(group, ()))
+
+	def submit(self, payload) -> bool:
+		key, revision = self.coalesce(payload)
+		group = self.group(payload)
+
+		if (latest := self._latest.get(key)) is not None and not self.supersedes(payload, latest.payload):
+			# A late retry or redelivery of an older push, there's nothing to do for it
+			log.info(f"Ignoring {key} at {revision}, {latest.revision} is newer")
+			self.superseded += 1
+			return True
+
+		if self.group_depth(group) >= self.max_size:
+			log.warning(f"Work queue of {group} is full ({self.group_depth(group)} items), refusing new work")
+			return False
+
+		if group not in self._queues:
+			self._queues[group] = collections.deque()
+			self._order.append(group)
+
+		item = WorkItem(payload, key, revision, group)
+		self._queues[group].append(item)
+		self._latest[key] = item
+		self._pending[key] = self._pending.get(key, 0) + 1
+		self._changed.set()
+
+		if (running := self._running.get(key)) and running[0] != revision:
+			log.info(f"Cancelling verification of {key} at {running[0]}, superseded by {revision}")
+			running[1].cancel()
+
+		return True
+
+	def _release(self, key :typing.Hashable):
+		# Forget about the key once nothing is queued or running for it
+		if not self._pending.get(key) and key not in self._running:
+			self._pending.pop(key, None)
+			self._latest.pop(key, None)
+
+	def _pick(self) -> WorkItem|None:
+		"""
+		Takes the next item of the first group in round-robin order that is below its limit.
+		"""
+		for _ in range(len(self._order)):
+			group = self._order[0]
+			# Whether we take from it or not, the group goes to the back of the line
+			self._order.rotate(-1)
+
+			if self._active.get(group, 0) >= (self.limit(group) or self.workers):
+				continue
+
+			queue = self._queues[group]
+			item = queue.popleft()
+			if not queue:
+				del self._queues[group]
+				self._order.remove(group)
+
+			self._active[group] = self._active.get(group, 0) + 1
+			return item
+
+		return None
+
+	def _done(self, group :typing.Hashable):
+		self._active[group] -= 1
+		if not self._active[group]:
+			del self._active[group]
+
+		# A slot opened up for the group
+		self._changed.set()
+
+	async def _next(self) -> WorkItem:
+		while (item := self._pick()) is None:
+			self._changed.clear()
+			await self._changed.wait()
+
+		return item
+
+	async def start(self):
+		self._tasks = [asyncio.create_task(self._worker(index)) for index in range(self.workers)]
+
+	async def stop(self):
+		for task in self._tasks:
+			task.cancel()
+
+		await asyncio.gather(*self._tasks, return_exceptions=True)
+		self._tasks = []
+
+	async def _worker(self, index :int):
+		while True:
+			item = await self._next()
+			self._pending[item.key] -= 1
+
+			if (latest := self._latest[item.key]).revision != item.revision:
+				log.info(f"Skipping verification of {item.key} at {item.revision}, superseded by {latest.revision}")
+				self.superseded += 1
+				self._release(item.key)
+				self._done(item.group)
+				continue
+
+			wait = time.monotonic() - item.enqueued_at
+			self.wait_last = wait
+			self.wait_max = max(self.wait_max, wait)
+			self.wait_total += wait
+			self.started += 1
+			self.busy += 1
+
+			task = asyncio.create_task(self.handler(item.payload))
+			self._running[item.key] = (item.revision, task)
+
+			try:
+				await task
+			except asyncio.CancelledError:
+				# Either the worker itself is being stopped, or the task got superseded
+				if asyncio.current_task().cancelling():
+					raise
+
+				self.superseded += 1
+			except Exception as error:
+				self.failed += 1
+				log.exception(f"Worker {index} failed to process work item: {error}")
+			finally:
+				self._running.pop(item.key, None)
+				self._release(item.key)
+				self._done(item.group)
+				self.busy -= 1
+				self.processed += 1
+
+	def oldest_wait(self) -> float:
+		"""
+		How long the oldest queued item has been waiting for a worker, in seconds.
+		"""
+		oldest = min((queue[0].enqueued_at for queue in self._queues.values()), default=None)
+
+		return time.monotonic() - oldest if oldest is not None else 0.0
+
+	def stats(self) -> dict:
+		groups = set(self._queues) | set(self._active)
+
+		return {
+			"queue_depth": self.depth(),
+			"queue_size": self.max_size,
+			"workers": self.workers,
+			"workers_busy": self.busy,
+			"utilisation": self.busy / self.workers if self.workers else 0.0,
+			"processed": self.processed,
+			"failed": self.failed,
+			"superseded": self.superseded,
+			"wait_seconds_last": self.wait_last,
+			"wait_seconds_max": self.wait_max,
+			"wait_seconds_avg": self.wait_total / self.started if self.started else 0.0,
+			"wait_seconds_oldest": self.oldest_wait(),
+			"groups": {
+				str(group): {"queued": self.group_depth(group), "running": self._active.get(group, 0)}
+				for group in groups
+			},
+		}
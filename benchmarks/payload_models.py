@@ -0,0 +1,40 @@
+"""
+Parse time and memory per pull_request delivery, for the full
+PullRequest model versus the SlimPullRequest model used on the hot path.
+
+	$ python benchmarks/payload_models.py [deliveries]
+"""
+import sys
+import json
+import time
+import tracemalloc
+
+from webhook_routing import github_models, synthetic
+
+def parse_time(model, body :bytes, count :int) -> float:
+	started = time.perf_counter()
+	for _ in range(count):
+		model.model_validate_json(body)
+
+	return (time.perf_counter() - started) / count
+
+def retained_memory(model, body :bytes, count :int = 100) -> float:
+	tracemalloc.start()
+	before = tracemalloc.get_traced_memory()[0]
+	parsed = [model.model_validate_json(body) for _ in range(count)]
+	after = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+
+	return (after - before) / len(parsed)
+
+if __name__ == '__main__':
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+	payload = synthetic(github_models.PullRequest)
+	payload['action'] = 'synchronize'
+	body = json.dumps(payload).encode()
+	print(f"Synthetic pull_request delivery of {len(body)} bytes")
+
+	print(f"{'model':<18} {'parse (us)':>12} {'memory (bytes)':>16}")
+	for model in (github_models.PullRequest, github_models.SlimPullRequest):
+		print(f"{model.__name__:<18} {parse_time(model, body, count) * 1e6:12.1f} {retained_memory(model, body):16.0f}")
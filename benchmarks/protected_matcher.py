@@ -0,0 +1,115 @@
+"""
+Micro-benchmark of the protected path check over synthetic diffs.
+Compares the old nested loop (every rule against every file) with
+the compiled ProtectedMatcher, on a diff with no protected files
+(the worst case, every file has to be checked).
+Before timing anything, the two are checked to give the same answer on
+randomly generated rules (escapes, classes, groups and quantifiers included).
+
+	$ python benchmarks/protected_matcher.py [files] [rules]
+"""
+import re
+import sys
+import time
+import random
+import pathlib
+import importlib.util
+
+# Loaded straight from the file, importing the autorun package loads the config
+spec = importlib.util.spec_from_file_location('matcher', pathlib.Path(__file__).parent.parent / 'autorun' / 'matcher.py')
+matcher = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(matcher)
+
+def synthetic_diff(count :int) -> list[str]:
+	random.seed(1337)
+	directories = ['src', 'vendor', 'docs', 'lib', 'pkg', 'internal', 'third_party']
+	extensions = ['.py', '.go', '.c', '.h', '.md', '.json', '.txt']
+
+	return [
+		'/'.join(random.choice(directories) + str(random.randrange(50)) for _ in range(random.randrange(1, 6)))
+		+ f'/file{index}{random.choice(extensions)}'
+		for index in range(count)
+	]
+
+def synthetic_rules(count :int) -> list[re.Pattern]:
+	rules = ['\\.github/.*', 'tests/.*\\.py$', 'Makefile$', '(^|/)setup\\.py$', 'ci/.*']
+	rules += [f'protected{index}/.*\\.(sh|yml)$' for index in range(count - len(rules))]
+
+	return [re.compile(rule) for rule in rules[:count]]
+
+def nested_loop(rules, filenames):
+	for filename in filenames:
+		for regex in rules:
+			if regex.search(filename) is not None:
+				return regex, filename
+
+	return None
+
+# Pieces the random rules are made of, the escapes spell out "." and "/" in every way re allows
+ATOMS = [
+	'.github/', 'tests/', 'setup', 'src1', 'workflows', '.py', '.yml', 'x',
+	'\\.', '\\/', '\\x2e', '\\x2egithub/', '\\056', '\\0', '\\u002e', '\\U0000002e', '\\N{FULL STOP}', '\\x2f',
+	'\\d', '\\w+', '\\b', '.', '.*', '^', '$', '[a-z]', '[.]', '[^/]+', '(a|b)', '(.github|tests)/', '(x)\\1',
+]
+QUANTIFIER_ATOMS = ['', '', '', '?', '*', '+', '{1,2}']
+PROTECTED_FILES = ['.github/workflows/x.yml', 'tests/test_1.py', 'src1/setup.py', 'a.py', 'xx', 'b/c', '.', '\0']
+
+def random_rules(count :int) -> list[re.Pattern]:
+	rules = []
+	while len(rules) < count:
+		pattern = ''.join(random.choice(ATOMS) + random.choice(QUANTIFIER_ATOMS) for _ in range(random.randrange(1, 4)))
+		try:
+			rules.append(re.compile(pattern))
+		except re.error:
+			continue
+
+	return rules
+
+def check_equivalence(rounds :int = 2000) -> int:
+	"""
+	Returns how many random rule sets the ProtectedMatcher answered differently than the nested loop.
+	"""
+	random.seed(42)
+	filenames = synthetic_diff(200)
+	mismatches = 0
+
+	for _ in range(rounds):
+		rules = random_rules(random.randrange(1, 6))
+		diff = random.sample(filenames, 20) + random.sample(PROTECTED_FILES, 3)
+		random.shuffle(diff)
+
+		protected = matcher.ProtectedMatcher(rules)
+		expected = nested_loop(rules, diff)
+		if protected.first(diff) != expected or any(protected.match(filename) != (nested_loop(rules, [filename]) or (None,))[0] for filename in diff):
+			mismatches += 1
+			print(f"Mismatch for {[rule.pattern for rule in rules]}: expected {expected}, got {protected.first(diff)}")
+
+	return mismatches
+
+def bench(name, function, *args, rounds=5):
+	best = float('inf')
+	for _ in range(rounds):
+		started = time.perf_counter()
+		result = function(*args)
+		best = min(best, time.perf_counter() - started)
+
+	print(f"{name:<20} {best * 1000:8.1f} ms  (match: {result})")
+	return best
+
+if __name__ == '__main__':
+	files = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+	rule_count = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+
+	if (mismatches := check_equivalence()):
+		sys.exit(f"ProtectedMatcher disagreed with the nested loop on {mismatches} rule sets")
+
+	filenames = synthetic_diff(files)
+	rules = synthetic_rules(rule_count)
+
+	started = time.perf_counter()
+	protected = matcher.ProtectedMatcher(rules)
+	print(f"Compiled {rule_count} rules in {(time.perf_counter() - started) * 1000:.2f} ms, checking {files} files")
+
+	before = bench("nested loop", nested_loop, rules, filenames)
+	after = bench("ProtectedMatcher", protected.first, filenames)
+	print(f"Speedup: {before / after:.1f}x")
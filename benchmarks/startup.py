@@ -0,0 +1,99 @@
+"""
+Cold start of github-autorun: how long `import autorun` takes, and how long
+from starting `python -m autorun` until the first webhook delivery is accepted.
+Runs against a throwaway config with a dummy token, the access check of the
+token runs in the background and is not waited for (and fails, which is fine here).
+
+	$ python benchmarks/startup.py [rounds]
+"""
+import os
+import sys
+import json
+import hmac
+import time
+import socket
+import hashlib
+import pathlib
+import tempfile
+import subprocess
+import urllib.error
+import urllib.request
+
+REPOSITORY = pathlib.Path(__file__).parent.parent
+SECRET = "startup-benchmark"
+
+def free_port() -> int:
+	with socket.socket() as sock:
+		sock.bind(('127.0.0.1', 0))
+		return sock.getsockname()[1]
+
+def write_config(directory :pathlib.Path, port :int):
+	(directory / 'github-autorun.toml').write_text(f"""
+[github]
+access_token = "github_pat_{'x' * 82}"
+repository = "Torxed/github-autorun"
+secret = "{SECRET}"
+
+[api]
+address = "127.0.0.1"
+port = {port}
+log_level = "ERROR"
+
+[cache]
+path = "{directory / 'cache'}"
+""")
+
+def environment() -> dict:
+	return {**os.environ, 'PYTHONPATH': str(REPOSITORY)}
+
+def import_time(directory :pathlib.Path) -> float:
+	started = time.perf_counter()
+	subprocess.run([sys.executable, '-c', 'import autorun'], cwd=directory, env=environment(), check=True)
+
+	return time.perf_counter() - started
+
+def first_accepted_webhook(directory :pathlib.Path, port :int, timeout :float = 60) -> float:
+	body = json.dumps({"zen": "Keep it logically awesome."}).encode()
+	request = urllib.request.Request(f'http://127.0.0.1:{port}/github/', data=body, headers={
+		'Content-Type': 'application/json',
+		'X-GitHub-Event': 'ping',
+		'X-Hub-Signature-256': 'sha256=' + hmac.new(SECRET.encode(), body, hashlib.sha256).hexdigest(),
+	})
+
+	started = time.perf_counter()
+	server = subprocess.Popen([sys.executable, '-m', 'autorun'], cwd=directory, env=environment(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	try:
+		while time.perf_counter() - started < timeout:
+			try:
+				with urllib.request.urlopen(request, timeout=1) as response:
+					if response.status == 202:
+						return time.perf_counter() - started
+			except (urllib.error.URLError, ConnectionError):
+				if server.poll() is not None:
+					raise RuntimeError(f"github-autorun exited with {server.returncode} before accepting a webhook")
+
+			time.sleep(0.01)
+
+		raise TimeoutError(f"No webhook was accepted within {timeout}s")
+	finally:
+		server.terminate()
+		server.wait()
+
+if __name__ == '__main__':
+	rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+	imports = []
+	starts = []
+	with tempfile.TemporaryDirectory() as directory:
+		directory = pathlib.Path(directory)
+
+		for _ in range(rounds):
+			port = free_port()
+			write_config(directory, port)
+			imports.append(import_time(directory))
+			starts.append(first_accepted_webhook(directory, port))
+
+	print(f"{'':<28} {'best (ms)':>10} {'median (ms)':>12}")
+	for name, timings in (("import autorun", imports), ("first accepted webhook", starts)):
+		timings = sorted(timings)
+		print(f"{name:<28} {timings[0] * 1000:10.0f} {timings[len(timings) // 2] * 1000:12.0f}")
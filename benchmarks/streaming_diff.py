@@ -0,0 +1,88 @@
+"""
+Benchmark of listing the changed files of a huge PR with git diff.
+Compares the old way (wait for git to finish, decode all of stdout and split it
+on newlines) with the streaming -z reader in git_cache, on a synthetic repository
+where the PR adds :code:`files` files and one protected file in the middle of them.
+Reports the peak memory held by Python and the time until the protected file is found.
+
+	$ python benchmarks/streaming_diff.py [files]
+"""
+import re
+import sys
+import time
+import asyncio
+import pathlib
+import tempfile
+import contextlib
+import subprocess
+import tracemalloc
+import importlib.util
+
+# Loaded straight from the files, importing the autorun package loads the config
+def load(name :str):
+	spec = importlib.util.spec_from_file_location(name, pathlib.Path(__file__).parent.parent / 'autorun' / f'{name}.py')
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+
+	return module
+
+git_cache = load('git_cache')
+matcher = load('matcher')
+
+PROTECTED = '.github/workflows/build.yml'
+
+def synthetic_repository(directory :pathlib.Path, files :int):
+	"""
+	A base commit with a single file, and refs/pull/1/head adding :code:`files` empty files on top of it.
+	"""
+	subprocess.run(['git', 'init', '-q', '--bare', str(directory)], check=True)
+
+	commands = [
+		"commit refs/heads/main", "committer bench <bench@localhost> 0 +0000", "data 4", "base",
+		"M 100644 inline README.md", "data 0", "",
+		"commit refs/pull/1/head", "committer bench <bench@localhost> 0 +0000", "data 4", "head", "from refs/heads/main",
+	]
+	for index in range(files):
+		if index == files // 2:
+			commands += [f"M 100644 inline {PROTECTED}", "data 0", ""]
+		commands += [f"M 100644 inline src/module{index % 100}/file{index}.py", "data 0", ""]
+
+	subprocess.run(['git', 'fast-import', '--quiet'], input='\n'.join(commands).encode() + b'\n', cwd=directory, check=True)
+
+async def buffered(directory :pathlib.Path, rules :matcher.ProtectedMatcher):
+	result = await git_cache.git('diff', '--name-only', '--no-renames', 'main', 'refs/pull/1/head', '--', cwd=directory)
+
+	return rules.first(result.stdout.decode().strip().split('\n'))
+
+async def streaming(directory :pathlib.Path, rules :matcher.ProtectedMatcher):
+	async with contextlib.aclosing(git_cache.git_stream('diff', '-z', '--name-only', '--no-renames', 'main', 'refs/pull/1/head', '--', cwd=directory)) as batches:
+		async for records in batches:
+			if (match := rules.first([record.decode(errors='replace') for record in records])) is not None:
+				return match
+
+def measure(function, directory :pathlib.Path, rules :matcher.ProtectedMatcher) -> tuple[float, int]:
+	tracemalloc.start()
+	started = time.perf_counter()
+
+	match = asyncio.run(function(directory, rules))
+
+	elapsed = time.perf_counter() - started
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+
+	assert match is not None and match[1] == PROTECTED, match
+	return elapsed, peak
+
+if __name__ == '__main__':
+	files = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+	rules = matcher.ProtectedMatcher([re.compile('\\.github/.*'), re.compile('tests/.*\\.py$')])
+
+	with tempfile.TemporaryDirectory() as directory:
+		directory = pathlib.Path(directory) / 'bench.git'
+		synthetic_repository(directory, files)
+
+		print(f"{files} changed files, the protected one in the middle")
+		print(f"{'':<12} {'time (ms)':>10} {'peak memory (KiB)':>18}")
+		for name, function in (("buffered", buffered), ("streaming", streaming)):
+			elapsed, peak = measure(function, directory, rules)
+			print(f"{name:<12} {elapsed * 1000:10.1f} {peak // 1024:18}")
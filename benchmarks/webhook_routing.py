@@ -0,0 +1,106 @@
+"""
+Requests per second per event type, before and after routing
+webhooks on the X-GitHub-Event header.
+
+ * before: FastAPI validates the body against Ping|PullRequest|WorkflowJob
+ * after: only the model of the event in the header is validated,
+   with parse_event() from autorun.github_models
+
+The payloads are synthetic but have every field the models require.
+
+	$ python benchmarks/webhook_routing.py [requests]
+"""
+import sys
+import json
+import time
+import types
+import typing
+import pathlib
+import datetime
+import importlib.util
+import fastapi
+import pydantic
+from fastapi.testclient import TestClient
+
+# Loaded straight from the file, importing the autorun package loads the config
+spec = importlib.util.spec_from_file_location('github_models', pathlib.Path(__file__).parent.parent / 'autorun' / 'github_models.py')
+github_models = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(github_models)
+
+def synthetic(model :type[pydantic.BaseModel]) -> dict:
+	return {name: synthetic_value(name, field.annotation) for name, field in model.model_fields.items() if field.is_required()}
+
+def synthetic_value(name :str, annotation):
+	if typing.get_origin(annotation) in (typing.Union, types.UnionType):
+		annotation = next(arg for arg in typing.get_args(annotation) if arg is not type(None))
+
+	if typing.get_origin(annotation) in (list, typing.List) or annotation is list:
+		return []
+	if isinstance(annotation, type) and issubclass(annotation, pydantic.BaseModel):
+		return synthetic(annotation)
+	if annotation is bool:
+		return False
+	if annotation is int:
+		return 1
+	if annotation is dict:
+		return {}
+	if annotation is datetime.datetime:
+		return "2024-01-01T00:00:00Z"
+	if name == 'ref':
+		return "main"
+	if name.endswith('sha'):
+		return "0" * 40
+	if name.endswith('url'):
+		return "https://github.com/Torxed/github-autorun"
+
+	return "github-autorun"
+
+def before_app() -> fastapi.FastAPI:
+	app = fastapi.FastAPI()
+
+	@app.post('/github/')
+	async def webhook_entry(payload :github_models.Ping|github_models.PullRequest|github_models.WorkflowJob, request :fastapi.Request):
+		await request.body()
+		return fastapi.Response(status_code=202)
+
+	return app
+
+def after_app() -> fastapi.FastAPI:
+	app = fastapi.FastAPI()
+
+	@app.post('/github/')
+	async def webhook_entry(request :fastapi.Request):
+		github_models.parse_event(request.headers.get('X-GitHub-Event', ''), await request.body())
+		return fastapi.Response(status_code=202)
+
+	return app
+
+def requests_per_second(app :fastapi.FastAPI, event :str, body :bytes, count :int) -> float:
+	headers = {'X-GitHub-Event': event, 'Content-Type': 'application/json'}
+
+	with TestClient(app) as client:
+		assert client.post('/github/', content=body, headers=headers).status_code == 202
+
+		started = time.perf_counter()
+		for _ in range(count):
+			client.post('/github/', content=body, headers=headers)
+
+		return count / (time.perf_counter() - started)
+
+if __name__ == '__main__':
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+
+	pull_request = synthetic(github_models.PullRequest)
+	pull_request['action'] = 'synchronize'
+	events = {
+		'ping': synthetic(github_models.Ping),
+		'pull_request': pull_request,
+		'workflow_job': synthetic(github_models.WorkflowJob),
+	}
+
+	print(f"{'event':<15} {'before req/s':>14} {'after req/s':>14} {'speedup':>9}")
+	for event, payload in events.items():
+		body = json.dumps(payload).encode()
+		before = requests_per_second(before_app(), event, body, count)
+		after = requests_per_second(after_app(), event, body, count)
+		print(f"{event:<15} {before:14.0f} {after:14.0f} {after / before:8.1f}x")